@@ -1,10 +1,23 @@
 import argparse
-import requests
 import json
 import os
+import re
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from appd_cache import DEFAULT_CACHE_DIR
+from appd_client import add_client_arguments, client_from_args
+from appd_rollout import (add_journal_arguments, confirm_all_applications, get_applications, open_journal,
+                          resolve_applications, run_rollout)
 
 PACKAGE = "com.john"
 DESCRIPTION = "test for john"
+DEFAULT_JOURNAL = os.path.join(DEFAULT_CACHE_DIR, "call-graph-exclude-journal.jsonl")
+
+EXCLUDED_PACKAGE = re.compile(r"^name=(?P<name>.*?),description=(?P<description>.*),system=(?P<system>true|false)$")
 
 def load_config(config_file):
     if not os.path.exists(config_file):
@@ -14,127 +27,152 @@ def load_config(config_file):
         config = f.read()
     return config
 
-def get_bearer_token(appd_controller_url, appd_client_id, appd_client_secret):
-    appd_account = appd_controller_url.split("/")[2].split(".")[0]
-    response = requests.post(
-        f"{appd_controller_url}controller/api/oauth/access_token",
-        headers={"Content-Type": "application/x-www-form-urlencoded"},
-        auth=(appd_client_id, appd_client_secret),
-        data={
-            "grant_type": "client_credentials",
-            "client_id": f"{appd_client_id}@{appd_account}",
-            "client_secret": appd_client_secret
-        }
-    )
-    response.raise_for_status()
-    return response.json()["access_token"]
-
-def get_application_id(appd_controller_url, bearer, appname):
-    response = requests.get(
-        f"{appd_controller_url}controller/rest/applications?output=JSON",
-        headers={"Authorization": f"Bearer {bearer}"}
-    )
-    response.raise_for_status()
-    apps = response.json()
-    for app in apps:
-        if app["name"] == appname:
-            return app["id"]
-    return None
-
-def get_app_configuration(appd_controller_url, bearer, app_id):
-    response = requests.get(
-        f"{appd_controller_url}controller/restui/applicationManagerUiBean/applicationConfiguration/{app_id}",
-        headers={
-            "Authorization": f"Bearer {bearer}",
-            "Content-Type": "application/json;charset=UTF-8",
-            "Accept": "application/json, text/plain, */*"
-        }
-    )
-    response.raise_for_status()
+def get_app_configuration(client, app_id):
+    response = client.get(f"/controller/restui/applicationManagerUiBean/applicationConfiguration/{app_id}")
     return response.json()
 
-def save_app_configuration(appd_controller_url, bearer, app_id, agent_type, config):
-    request_headers = {
-        "Authorization": f"Bearer {bearer}",
-        "Content-Type": "application/json;charset=UTF-8",
-        "Accept": "application/json, text/plain, */*"
-    }
+def save_app_configuration(client, app_id, agent_type, config):
     request_body = {
         "agentType": agent_type,
         "applicationId": app_id,
         "config": config
     }
 
-    response = requests.post(
-        f"{appd_controller_url}controller/restui/configuration/callGraph/save",
-        headers=request_headers,
+    client.post(
+        "/controller/restui/configuration/callGraph/save",
         json=request_body
     )
+    client.invalidate_response(f"/controller/restui/applicationManagerUiBean/applicationConfiguration/{app_id}")
+    return
 
-    if response.status_code >= 300:
-        print(f"Error: {response.status_code} - {response.text}")
-        # Print the request body for debugging
-        print("Request header:", json.dumps(request_headers, indent=2))
-        print("Request body:", json.dumps(request_body, indent=2))
+def excluded_package_fields(entry):
+    match = EXCLUDED_PACKAGE.match(entry)
+    if match is None:
+        return entry, False
+    return match.group("name"), match.group("system") == "true"
+
+def add_excluded_packages(packages, config):
+    """Add (name, description) pairs not already excluded by name, in one pass over the existing list."""
+    excluded = config.setdefault("excludedPackages", [])
+    present = {excluded_package_fields(entry)[0] for entry in excluded}
+    for name, desc in packages:
+        if name not in present:
+            excluded.append(f"name={name},description={desc},system=false")
+            present.add(name)
+    return config
 
-    response.raise_for_status()
-    return
+def remove_excluded_packages(names, config):
+    """Remove the non-system excluded packages with any of the given names."""
+    if "excludedPackages" in config:
+        names = set(names)
+        kept = []
+        for entry in config["excludedPackages"]:
+            name, system = excluded_package_fields(entry)
+            if system or name not in names:
+                kept.append(entry)
+        config["excludedPackages"] = kept
+    return config
 
 def add_excluded_package(name, desc, config):
-    package = f"name={name},description={desc},system=false"
-    if "excludedPackages" not in config:
-        config["excludedPackages"] = []
-    if package not in config["excludedPackages"]:
-        config["excludedPackages"].append(package)
-    return config
+    return add_excluded_packages([(name, desc)], config)
 
 def remove_excluded_package(name, desc, config):
-    package = f"name={name},description={desc},system=false"
-    if "excludedPackages" in config and package in config["excludedPackages"]:
-        config["excludedPackages"].remove(package)
-    return config
+    return remove_excluded_packages([name], config)
 
 def get_config_section(section, config):
     return config.get(section, {})
 
-def update_dotnet_config(appd_controller_url, bearer, app_id, app_config, verb):
-    dotnet_config = get_config_section("dotNetCallGraphConfiguration", app_config)
-    if verb == "add":
-        dotnet_config = add_excluded_package(PACKAGE, DESCRIPTION, dotnet_config)
-    elif verb == "remove":
-        dotnet_config = remove_excluded_package(PACKAGE, DESCRIPTION, dotnet_config)
-    save_app_configuration(appd_controller_url, bearer, app_id, "DOT_NET_APP_AGENT", dotnet_config)
-
-def update_callgraph_config(appd_controller_url, bearer, app_id, app_config, verb):
-    callgraph_config = get_config_section("callGraphConfiguration", app_config)
-    if verb == "add":
-        callgraph_config = add_excluded_package(PACKAGE, DESCRIPTION, callgraph_config)
-    elif verb == "remove":
-        callgraph_config = remove_excluded_package(PACKAGE, DESCRIPTION, callgraph_config)
-    save_app_configuration(appd_controller_url, bearer, app_id, "APP_AGENT", callgraph_config)
-
-def update_application_config(appd_controller_url, bearer, app_name, verb, agent_type):
-    app_id = get_application_id(appd_controller_url, bearer, app_name)
-    app_config = get_app_configuration(appd_controller_url, bearer, app_id)
-
-    if agent_type in ["both", "dotnet"]:
-        update_dotnet_config(appd_controller_url, bearer, app_id, app_config, verb)
-    if agent_type in ["both", "java"]:
-        update_callgraph_config(appd_controller_url, bearer, app_id, app_config, verb)
-
-def get_all_applications(appd_controller_url, bearer):
-    response = requests.get(
-        f"{appd_controller_url}controller/rest/applications?output=JSON",
-        headers={"Authorization": f"Bearer {bearer}"}
-    )
-    response.raise_for_status()
-    return [app["name"] for app in response.json()]
-
-def update_all_applications(appd_controller_url, bearer, verb, agent_type):
-    applications = get_all_applications(appd_controller_url, bearer)
-    for app in applications:
-        print(f"Running for \"{app}\"")
-        update_application_config(appd_controller_url, bearer, app, verb, agent_type)
+def update_config_section(client, app_id, app_config, section, agent_type, packages, plan=False):
+    """Apply the manifest packages to one agent section and save it only if it changed, returning the changes as diff lines."""
+    config = get_config_section(section, app_config)
+    before = set(config.get("excludedPackages", []))
+    config = add_excluded_packages([(package["name"], package["description"]) for package in packages if package["verb"] == "add"], config)
+    config = remove_excluded_packages([package["name"] for package in packages if package["verb"] == "remove"], config)
+    after = set(config.get("excludedPackages", []))
+
+    diff = [f"{agent_type} - {package}" for package in sorted(before - after)] + \
+           [f"{agent_type} + {package}" for package in sorted(after - before)]
+    if diff and not plan:
+        save_app_configuration(client, app_id, agent_type, config)
+    return diff
+
+def update_dotnet_config(client, app_id, app_config, packages, plan=False):
+    return update_config_section(client, app_id, app_config, "dotNetCallGraphConfiguration", "DOT_NET_APP_AGENT", packages, plan)
+
+def update_callgraph_config(client, app_id, app_config, packages, plan=False):
+    return update_config_section(client, app_id, app_config, "callGraphConfiguration", "APP_AGENT", packages, plan)
+
+def update_application_config(client, app_id, packages, plan=False):
+    """One GET for the application and at most one save per agent section, whatever the number of packages."""
+    app_config = get_app_configuration(client, app_id)
+
+    diff = []
+    dotnet_packages = [package for package in packages if package["agent_type"] in ["both", "dotnet"]]
+    if dotnet_packages:
+        diff += update_dotnet_config(client, app_id, app_config, dotnet_packages, plan)
+    java_packages = [package for package in packages if package["agent_type"] in ["both", "java"]]
+    if java_packages:
+        diff += update_callgraph_config(client, app_id, app_config, java_packages, plan)
+    return diff
+
+def get_all_applications(client):
+    # a fresh inventory, so applications created since it was cached aren't skipped
+    return [(app["name"], app["id"]) for app in get_applications(client, refresh=True)]
+
+def update_applications(client, applications, packages, workers=1, plan=False, journal=None):
+    """Run the read-modify-write cycle for (name, id) pairs on up to workers threads, returning a result record per application."""
+    return run_rollout(lambda app_id: update_application_config(client, app_id, packages, plan), applications, workers, plan,
+                       journal=journal)
+
+def update_all_applications(client, packages, workers=1, plan=False, journal=None):
+    return update_applications(client, get_all_applications(client), packages, workers, plan, journal)
+
+def update_named_applications(client, app_names, packages, workers=1, plan=False, journal=None):
+    applications, missing = resolve_applications(client, app_names)
+    return update_applications(client, applications, packages, workers, plan, journal), missing
+
+def load_manifest(file_path):
+    if not os.path.exists(file_path):
+        print(f"Manifest file {file_path} does not exist")
+        exit(1)
+    with open(file_path) as f:
+        if file_path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                print("Reading a YAML manifest needs PyYAML, install it with 'pip install pyyaml' or use a JSON manifest")
+                exit(1)
+            try:
+                manifest = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                print(f"Manifest file {file_path} is not valid YAML: {e}")
+                exit(1)
+        else:
+            try:
+                manifest = json.load(f)
+            except ValueError as e:
+                print(f"Manifest file {file_path} is not valid JSON: {e}")
+                exit(1)
+
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("packages"), list) or not manifest["packages"]:
+        print(f"Manifest file {file_path} needs a packages list with at least one entry")
+        exit(1)
+    packages = []
+    seen = set()
+    for entry in manifest["packages"]:
+        if not isinstance(entry, dict) or not isinstance(entry.get("name"), str) or not entry["name"]:
+            print(f"Manifest entry {entry} needs a package name")
+            exit(1)
+        package = {"name": entry["name"], "description": entry.get("description", ""),
+                   "verb": entry.get("verb", "add"), "agent_type": entry.get("agent_type", "both")}
+        if package["verb"] not in ["add", "remove"] or package["agent_type"] not in ["java", "dotnet", "both"]:
+            print(f"Manifest entry {entry} needs a verb of add or remove and an agent_type of java, dotnet or both")
+            exit(1)
+        for agent in (["java", "dotnet"] if package["agent_type"] == "both" else [package["agent_type"]]):
+            if (agent, package["name"]) in seen:
+                print(f"Manifest lists {package['name']} more than once for {agent} agents")
+                exit(1)
+            seen.add((agent, package["name"]))
+        packages.append(package)
+    return packages
 
 def load_application_list(file_path):
     if not os.path.exists(file_path):
@@ -148,9 +186,14 @@ def main():
     parser = argparse.ArgumentParser(description="AppDynamics Configuration Script")
     parser.add_argument("-a", "--application", required=True, help="Application Name|ALL|file containing application names")
     parser.add_argument("-c", "--config", default="appdynamics-configuration.sh", help="Config file")
+    parser.add_argument("-m", "--manifest", help="JSON or YAML file listing packages to add or remove per agent type, instead of PACKAGE/DESCRIPTION with --verb and --agent_type")
     parser.add_argument("-v", "--verb", choices=["add", "remove"], default="add", help="Action to perform: add or remove")
     parser.add_argument("-t", "--agent_type", choices=["java", "dotnet", "both"], default="both", help="Agent type to update: java, dotnet, or both")
     parser.add_argument("-d", "--debug", action="store_true", help="Enable debug mode")
+    parser.add_argument("--plan", action="store_true", help="Show the changes each application would get without saving anything")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of applications to update concurrently")
+    add_journal_arguments(parser, DEFAULT_JOURNAL)
+    add_client_arguments(parser)
     args = parser.parse_args()
 
     if args.debug:
@@ -168,23 +211,34 @@ def main():
         print(f"Could not load AppDynamics Configuration from {args.config}, please set that up or something")
         exit(1)
 
-    bearer = get_bearer_token(appd_controller_url, appd_client_id, appd_client_secret)
+    client = client_from_args(args, appd_controller_url, appd_client_id, appd_client_secret, pool_size=args.workers)
+    client.get_bearer_token()
 
+    if args.manifest:
+        packages = load_manifest(args.manifest)
+    else:
+        packages = [{"name": PACKAGE, "description": DESCRIPTION, "verb": args.verb, "agent_type": args.agent_type}]
+
+    journal = open_journal(args, {"controller": client.controller_url, "packages": packages})
+
+    missing = []
     if args.application == "ALL":
-        confirmation = input(f"Please confirm with a 'YES' if you intended to run this for all applications on the controller {appd_controller_url}: ")
-        if confirmation == "YES":
-            print("Confirmed")
-            update_all_applications(appd_controller_url, bearer, args.verb, args.agent_type)
-        else:
-            print("That was not a confirmation, so exiting")
-            exit(1)
+        confirm_all_applications(appd_controller_url, args.plan)
+        results = update_all_applications(client, packages, args.workers, args.plan, journal)
     else:
         if os.path.isfile(args.application):
             applications = load_application_list(args.application)
-            for app in applications:
-                update_application_config(appd_controller_url, bearer, app, args.verb, args.agent_type)
         else:
-            update_application_config(appd_controller_url, bearer, args.application, args.verb, args.agent_type)
+            applications = [args.application]
+        results, missing = update_named_applications(client, applications, packages, args.workers, args.plan, journal)
+
+    if args.debug and client.response_cache is not None:
+        print(client.response_cache.summary())
+    if client.stats is not None:
+        client.stats.write(args.stats, args.stats_file)
+
+    if missing or any(result["result"] == "failed" for result in results):
+        exit(1)
 
 if __name__ == "__main__":
     main()
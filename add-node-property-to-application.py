@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import shlex
+
+import requests
+
+from appd_cache import DEFAULT_CACHE_DIR
+from appd_client import add_client_arguments, client_from_args, fan_out
+from appd_rollout import (add_journal_arguments, confirm_all_applications, get_applications, open_journal,
+                          resolve_applications, run_rollout)
+
+DEFAULT_JOURNAL = os.path.join(DEFAULT_CACHE_DIR, "node-property-journal.jsonl")
+
+def load_config(config_file):
+    if not os.path.exists(config_file):
+        print(f"Config file {config_file} does not exist")
+        exit(1)
+    with open(config_file) as f:
+        config = f.read()
+    return config
+
+def load_property_file(file_path):
+    """Read AGENT_TYPE and NEW_NODE_PROPERTY from a shell property file like new_property.sh."""
+    if not file_path or not os.path.exists(file_path):
+        print("PROPERTY_FILE needs to be set with valid node property to add")
+        exit(1)
+    values = {}
+    with open(file_path) as f:
+        for line in f:
+            words = shlex.split(line, comments=True)
+            if words and words[0] == "export":
+                words = words[1:]
+            for word in words:
+                name, _, value = word.partition("=")
+                values[name] = value
+    if not values.get("AGENT_TYPE") or not values.get("NEW_NODE_PROPERTY"):
+        print("Property file does not set AGENT_TYPE and/or NEW_NODE_PROPERTY")
+        exit(1)
+    return values["AGENT_TYPE"], json.loads(values["NEW_NODE_PROPERTY"])
+
+def get_agent_configuration(client, agent_type, entity_type, entity_id):
+    request_body = {
+        "checkAncestors": False,
+        "key": {
+            "agentType": agent_type,
+            "attachedEntity": {"id": None, "version": None, "entityId": entity_id, "entityType": entity_type}
+        }
+    }
+    response = client.post("/controller/restui/agentManager/getAgentConfiguration", json=request_body)
+    return response.json()
+
+def set_agent_configuration(client, configuration):
+    client.post("/controller/restui/agentManager/updateAgentConfigurationAndToggleAgentEnableStatusIfNeeded",
+                json=configuration)
+    return
+
+def add_node_property(client, agent_type, node_property, entity_type, entity_id, plan=False):
+    """Add the property to one application or tier configuration unless it already has one by that name."""
+    configuration = get_agent_configuration(client, agent_type, entity_type, entity_id)
+    name = node_property["definition"]["name"]
+    properties = configuration.setdefault("properties", [])
+    if any(existing.get("definition", {}).get("name") == name for existing in properties):
+        return []
+    properties.append(node_property)
+    if not plan:
+        set_agent_configuration(client, configuration)
+    return [f"{entity_type} {entity_id} + {name}={node_property.get('stringValue')}"]
+
+def get_customized_tiers(client, agent_type, app_id):
+    response = client.get(f"/controller/restui/agentManager/getAllApplicationComponentsWithNodes/{app_id}")
+    return [tier for component in response.json() for tier in component.get("children", [])
+            if tier.get("agentType") == agent_type and tier.get("customized")]
+
+def get_tiers(client, app_id):
+    return client.cached_inventory(f"rest/applications/{app_id}/tiers",
+                                   lambda: client.get(f"/controller/rest/applications/{app_id}/tiers?output=JSON").json())
+
+def customized_tier_targets(client, agent_type, applications, workers=1, journal=None):
+    """Look up the customized tiers of every application concurrently, as rollout targets.
+
+    An application whose tiers can't be looked up is reported, and recorded in the journal, as failed
+    without stopping the others; returns the targets and a failed result record per such application.
+    """
+    targets = []
+    failures = []
+    for (app_name, app_id), future in fan_out(lambda application: get_customized_tiers(client, agent_type, application[1]),
+                                              applications, workers):
+        try:
+            targets += [(f"{app_name}/{tier['name']}", ("APPLICATION_COMPONENT", tier["id"])) for tier in future.result()]
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            result = {"target": f"{app_name}/*", "id": ("APPLICATION_TIERS", app_id), "result": "failed",
+                      "error": f"tier lookup failed: {e}"}
+            print(f"\"{result['target']}\": failed - {result['error']}")
+            if journal is not None:
+                journal.record(result)
+            failures.append(result)
+    return targets, failures
+
+def named_tier_targets(client, applications, tier_name):
+    targets = []
+    for app_name, app_id in applications:
+        tier_ids = [tier["id"] for tier in get_tiers(client, app_id) if tier["name"] == tier_name]
+        if not tier_ids:
+            print(f"Tier \"{tier_name}\" not found in application \"{app_name}\"")
+        targets += [(f"{app_name}/{tier_name}", ("APPLICATION_COMPONENT", tier_id)) for tier_id in tier_ids]
+    return targets
+
+def update_node_properties(client, agent_type, node_property, targets, workers=1, plan=False, journal=None):
+    return run_rollout(lambda entity: add_node_property(client, agent_type, node_property, *entity, plan),
+                       targets, workers, plan, noun="applications and tiers", journal=journal)
+
+def main():
+    parser = argparse.ArgumentParser(description="Add a node property to AppDynamics applications and tiers")
+    parser.add_argument("-p", "--property_file", required=True, help="Property file setting AGENT_TYPE and NEW_NODE_PROPERTY, like new_property.sh")
+    parser.add_argument("-a", "--application", required=True, help="Application Name|ALL")
+    parser.add_argument("-t", "--tier", default="NONE", help="Tier Name|ALL|NONE, ALL updates the customized tiers of the agent type")
+    parser.add_argument("-c", "--config", default="appdynamics-configuration.sh", help="Config file")
+    parser.add_argument("-d", "--debug", action="store_true", help="Enable debug mode")
+    parser.add_argument("--plan", action="store_true", help="Show the applications and tiers that would get the property without saving anything")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of applications and tiers to update concurrently")
+    add_journal_arguments(parser, DEFAULT_JOURNAL, noun="applications and tiers")
+    add_client_arguments(parser)
+    args = parser.parse_args()
+
+    if args.debug:
+        import logging
+        logging.basicConfig(level=logging.DEBUG)
+
+    config = load_config(args.config)
+    exec(config, globals())
+
+    appd_controller_url = globals().get("APPD_CONTROLLER_URL")
+    appd_client_id = globals().get("APPD_CLIENT_ID")
+    appd_client_secret = globals().get("APPD_CLIENT_SECRET")
+
+    if not all([appd_controller_url, appd_client_id, appd_client_secret]):
+        print(f"Could not load AppDynamics Configuration from {args.config}, please set that up or something")
+        exit(1)
+
+    agent_type, node_property = load_property_file(args.property_file)
+
+    client = client_from_args(args, appd_controller_url, appd_client_id, appd_client_secret, pool_size=args.workers)
+    client.get_bearer_token()
+
+    missing = []
+    lookup_failures = []
+    if args.application == "ALL":
+        if args.tier not in ["NONE", "ALL"]:
+            print("We don't support the option of all applications and one specific tier, don't try this again")
+            exit(1)
+        confirm_all_applications(appd_controller_url, args.plan)
+        # a fresh inventory, so applications created since it was cached aren't skipped
+        applications = [(app["name"], app["id"]) for app in get_applications(client, refresh=True)]
+    else:
+        applications, missing = resolve_applications(client, [args.application])
+
+    journal = open_journal(args, {"controller": client.controller_url, "agent_type": agent_type, "property": node_property})
+
+    if args.tier == "NONE":
+        targets = [(app_name, ("APPLICATION", app_id)) for app_name, app_id in applications]
+    elif args.tier == "ALL":
+        targets, lookup_failures = customized_tier_targets(client, agent_type, applications, args.workers, journal)
+        if args.application == "ALL":
+            targets = [(app_name, ("APPLICATION", app_id)) for app_name, app_id in applications] + targets
+    else:
+        targets = named_tier_targets(client, applications, args.tier)
+        if applications and not targets:
+            missing.append(f"{args.application}/{args.tier}")
+
+    results = lookup_failures + update_node_properties(client, agent_type, node_property, targets, args.workers, args.plan, journal)
+
+    if args.debug and client.response_cache is not None:
+        print(client.response_cache.summary())
+    if client.stats is not None:
+        client.stats.write(args.stats, args.stats_file)
+
+    if missing or any(result["result"] == "failed" for result in results):
+        exit(1)
+
+if __name__ == "__main__":
+    main()
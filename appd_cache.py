@@ -0,0 +1,278 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".appdynamics")
+DEFAULT_TOKEN_CACHE = os.path.join(DEFAULT_CACHE_DIR, "token-cache.json")
+DEFAULT_INVENTORY_SNAPSHOT = os.path.join(DEFAULT_CACHE_DIR, "inventory-cache.json")
+DEFAULT_INVENTORY_TTL = 900
+DEFAULT_RESPONSE_CACHE_SIZE = 256
+
+# seconds to reuse responses from slow-changing endpoints, matched by exact path, or by prefix for the ones
+# ending in /, so sub-resources aren't cached by accident. 0 is revalidated with the controller
+# (ETag / Last-Modified) on every use. The application inventory isn't here, the inventory cache
+# keeps it and --refresh-inventory clears it there
+RESPONSE_CACHE_TTLS = {
+    "/controller/databasesui/databases/list": 300,
+    "/controller/restui/applicationManagerUiBean/applicationConfiguration/": 0,
+    "/controller/argento/public-api/v1/applications": 900,
+}
+
+# request body fields left out of response cache keys, the cached endpoints answer the same for any window
+WINDOW_FIELDS = {"timeRangeStart", "timeRangeEnd"}
+
+# tokens are refreshed this many seconds before the controller says they expire
+TOKEN_REFRESH_MARGIN = 60
+
+
+@contextmanager
+def locked_file(path):
+    """Hold an exclusive lock on path + ".lock" so concurrent script runs don't interleave updates."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+    fd = os.open(f"{path}.lock", os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def read_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(path, data):
+    # write to the side and rename, so readers never see a half written file
+    temp_path = f"{path}.tmp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_path, path)
+
+
+def cache_unavailable(kind, path, error):
+    logging.warning(f"Not using the {kind} {path}, it can't be read or written: {error}")
+
+
+class TokenCache:
+    """Bearer tokens on disk, keyed by controller URL and client id, shared between script runs.
+
+    When the file can't be read or written, e.g. for an account without a writable home directory,
+    the cache turns itself off and every token is requested from the controller.
+    """
+
+    def __init__(self, path=DEFAULT_TOKEN_CACHE):
+        self.path = path
+
+    @staticmethod
+    def _key(controller_url, client_id):
+        return f"{controller_url.rstrip('/')}|{client_id}"
+
+    def _disable(self, error):
+        cache_unavailable("token cache", self.path, error)
+        self.path = None
+
+    def get(self, controller_url, client_id):
+        if self.path is None:
+            return None
+        try:
+            with locked_file(self.path):
+                entry = read_json(self.path, {}).get(self._key(controller_url, client_id))
+        except OSError as e:
+            self._disable(e)
+            return None
+        if entry and entry["expires_at"] - TOKEN_REFRESH_MARGIN > time.time():
+            return entry
+        return None
+
+    def put(self, controller_url, client_id, access_token, expires_at):
+        if self.path is None:
+            return
+        try:
+            with locked_file(self.path):
+                now = time.time()
+                tokens = {key: entry for key, entry in read_json(self.path, {}).items() if entry["expires_at"] > now}
+                tokens[self._key(controller_url, client_id)] = {"access_token": access_token, "expires_at": expires_at}
+                write_json(self.path, tokens)
+        except OSError as e:
+            self._disable(e)
+
+    def invalidate(self, controller_url, client_id):
+        if self.path is None:
+            return
+        try:
+            with locked_file(self.path):
+                tokens = read_json(self.path, {})
+                if tokens.pop(self._key(controller_url, client_id), None) is not None:
+                    write_json(self.path, tokens)
+        except OSError as e:
+            self._disable(e)
+
+
+class InventoryCache:
+    """Application inventory lookups, reused for ttl seconds by every collector sharing the cache.
+
+    With a snapshot_path the inventory is also kept on disk, so a restarted run starts from the last
+    known inventory, and falls back to it (stale) if the controller can't be reached; a snapshot that
+    can't be written is given up on, and the cache kept in memory only. Cached values are shared, so
+    callers must not modify them.
+    """
+
+    def __init__(self, ttl=DEFAULT_INVENTORY_TTL, snapshot_path=None):
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self.entries = read_json(snapshot_path, {}) if snapshot_path else {}
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+
+    def get(self, key, fetch):
+        entry = self.entries.get(key)
+        if entry and time.time() - entry["fetched_at"] < self.ttl:
+            return entry["value"]
+        # one fetch per key at a time, the other callers wait for it and reuse the result
+        with self._lock:
+            fetch_lock = self._fetch_locks.setdefault(key, threading.Lock())
+        with fetch_lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry["fetched_at"] < self.ttl:
+                return entry["value"]
+            try:
+                value = fetch()
+            except Exception as e:
+                if entry is None:
+                    raise
+                logging.warning(f"Using inventory from {time.ctime(entry['fetched_at'])} for {key}, refresh failed: {e}")
+                return entry["value"]
+            self.entries[key] = {"fetched_at": time.time(), "value": value}
+            self._save()
+            return value
+
+    def invalidate(self, prefix=""):
+        with self._lock:
+            removed = [key for key in self.entries if key.startswith(prefix)]
+            for removed_key in removed:
+                self.entries.pop(removed_key, None)
+        self._save(removed)
+
+    def _save(self, removed=()):
+        if not self.snapshot_path:
+            return
+        try:
+            with locked_file(self.snapshot_path):
+                # merge, so runs against other controllers sharing the snapshot keep their entries
+                snapshot = {**read_json(self.snapshot_path, {}), **self.entries}
+                for key in removed:
+                    snapshot.pop(key, None)
+                write_json(self.snapshot_path, snapshot)
+        except OSError as e:
+            cache_unavailable("inventory snapshot", self.snapshot_path, e)
+            self.snapshot_path = None
+
+
+class ResponseCache:
+    """Responses from slow-changing controller endpoints, in an LRU of max_entries and optionally on disk.
+
+    Entries are plain dicts with the response text and its ETag / Last-Modified validators. A fresh entry
+    is used as is, a stale one with validators is revalidated with a conditional request, so the
+    controller only sends the body again when it changed. With a directory, each entry is also a file
+    there, so later runs start warm.
+    """
+
+    def __init__(self, max_entries=DEFAULT_RESPONSE_CACHE_SIZE, directory=None, ttls=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.ttls = dict(RESPONSE_CACHE_TTLS, **(ttls or {}))
+        self.entries = OrderedDict()
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        if directory:
+            try:
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+            except OSError as e:
+                self._disable(e)
+
+    def _disable(self, error):
+        # carry on with the in-memory cache only
+        cache_unavailable("response cache directory", self.directory, error)
+        self.directory = None
+
+    def ttl_for(self, path):
+        path = path.split("?", 1)[0]
+        for prefix, ttl in self.ttls.items():
+            if path == prefix or (prefix.endswith("/") and path.startswith(prefix)):
+                return ttl
+        return None
+
+    @staticmethod
+    def key(method, url, params=None, body=None):
+        if isinstance(body, dict):
+            body = {name: value for name, value in body.items() if name not in WINDOW_FIELDS}
+        return hashlib.sha256(json.dumps([method, url, params, body], sort_keys=True, default=str).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        if self.directory:
+            entry = read_json(self._path(key), None)
+            if entry is not None:
+                self._remember(key, entry)
+        return entry
+
+    def is_fresh(self, entry, ttl):
+        return time.time() - entry["stored_at"] < ttl
+
+    def put(self, key, entry):
+        self._remember(key, entry)
+        if self.directory:
+            try:
+                write_json(self._path(key), entry)
+            except OSError as e:
+                self._disable(e)
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self.entries.pop(key, None)
+        if self.directory:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self._disable(e)
+
+    def count(self, outcome):
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def summary(self):
+        lookups = self.stats["hit"] + self.stats["revalidated"] + self.stats["miss"]
+        return (f"response cache: {lookups} lookups, {self.stats['hit']} hits, {self.stats['revalidated']} revalidated, "
+                f"{self.stats['miss']} misses")
@@ -0,0 +1,469 @@
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+from itertools import islice
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+import appd_json
+from appd_cache import (DEFAULT_INVENTORY_SNAPSHOT, DEFAULT_INVENTORY_TTL, DEFAULT_RESPONSE_CACHE_SIZE, DEFAULT_TOKEN_CACHE,
+                        TOKEN_REFRESH_MARGIN, InventoryCache, ResponseCache, TokenCache)
+from appd_stats import STATS_FORMATS, RequestStats, endpoint_name
+
+TOKEN_PATH = "/controller/api/oauth/access_token"
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = (10, 60)
+
+# transient failures are retried this many times, waiting a random share of RETRY_BACKOFF * 2 ** attempt
+# seconds in between, or as long as the controller's Retry-After asks for, up to MAX_RETRY_AFTER
+DEFAULT_RETRIES = 3
+RETRY_BACKOFF = 1.0
+MAX_RETRY_AFTER = 120
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# responses that mean the controller is overloaded, as opposed to a failed request
+THROTTLE_STATUSES = {429, 502, 503, 504}
+
+# adaptive concurrency halves the requests in flight when a response is throttled or takes LATENCY_TOLERANCE
+# times its endpoint's usual latency; latency increases under LATENCY_FLOOR seconds are noise, not congestion
+LATENCY_TOLERANCE = 3.0
+LATENCY_FLOOR = 0.1
+
+# (connect, read) timeouts in seconds, matched by path prefix; the first match wins
+ENDPOINT_TIMEOUTS = {
+    TOKEN_PATH: (10, 30),
+    "/controller/restui/v1/bt/listViewDataByColumnsV2": (10, 120),
+    "/controller/databasesui/databases/list": (10, 180),
+    "/controller/sim/v2/user/metrics/query/machines": (10, 300),
+    "/controller/sim/v2/user/health": (10, 180),
+}
+
+
+class RateLimiter:
+    """Token bucket shared by every thread issuing requests through one client."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on the requests in flight, shared by every thread issuing requests through one client.
+
+    The limit starts at max_limit. Each prompt response raises it by 1 / limit, so by about one per
+    round of requests, and a throttled or slow response halves it, once per round: responses to
+    requests sent before the last decrease don't decrease it again. A Retry-After from the
+    controller holds back every thread, not just the one that got it.
+    """
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        # per endpoint, the lower envelope of its latency, drifting up slowly if the endpoint gets slower
+        self.baselines = {}
+        self.paused_until = 0.0
+        self.decreased_at = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    self._condition.wait(pause)
+                elif self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                else:
+                    self._condition.wait()
+
+    def release(self, endpoint, started, throttled=False, retry_after=None):
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            seconds = now - started
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+            baseline = self.baselines.get(endpoint, seconds)
+            slow = seconds > max(LATENCY_TOLERANCE * baseline, baseline + LATENCY_FLOOR)
+            if not throttled:
+                self.baselines[endpoint] = seconds if seconds < baseline else baseline + (seconds - baseline) * 0.01
+            if throttled or slow:
+                if started >= self.decreased_at and self.limit > self.min_limit:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self.decreased_at = now
+                    logging.info(f"Controller {'throttled' if throttled else 'slowed down'} on {endpoint}, "
+                                 f"limiting to {int(self.limit)} requests in flight")
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class ControllerClient:
+    def __init__(self, controller_url, client_id, client_secret, pool_size=DEFAULT_POOL_SIZE, timeouts=None,
+                 rate_limit=None, token_cache=None, inventory_cache=None, response_cache=None, retries=DEFAULT_RETRIES,
+                 stats=None, adaptive_concurrency=True, name=None, debug=False):
+        self.controller_url = controller_url.rstrip("/")
+        # how output records and stats refer to this controller
+        self.name = name or urlparse(self.controller_url).hostname
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.timeouts = dict(ENDPOINT_TIMEOUTS, **(timeouts or {}))
+        self.retries = retries
+        self.debug = debug
+        self.bearer = None
+        self.bearer_expires_at = None
+        self.token_cache = token_cache
+        self.inventory_cache = inventory_cache
+        self.response_cache = response_cache
+        self.stats = stats
+        self._token_lock = threading.Lock()
+        # a client only ever talks to one controller host, so this is the per-host request rate
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        # no more requests in flight than the pool has connections, fewer while the controller pushes back
+        self.concurrency = AdaptiveConcurrency(pool_size) if adaptive_concurrency else None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Accept": "application/json, text/plain, */*",
+            "Accept-Encoding": "gzip, deflate",
+        })
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_bearer_token(self, force=False):
+        if self.token_cache and not force:
+            cached = self.token_cache.get(self.controller_url, self.client_id)
+            if cached:
+                self._use_bearer(cached["access_token"], cached["expires_at"])
+                return self.bearer
+
+        appd_account = self.controller_url.split("/")[2].split(".")[0]
+        response = self.request(
+            "POST",
+            TOKEN_PATH,
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            auth=(self.client_id, self.client_secret),
+            data={
+                "grant_type": "client_credentials",
+                "client_id": f"{self.client_id}@{appd_account}",
+                "client_secret": self.client_secret
+            }
+        )
+        token = response.json()
+        expires_at = time.time() + token["expires_in"] if token.get("expires_in") else None
+        self._use_bearer(token["access_token"], expires_at)
+        if self.token_cache and expires_at:
+            self.token_cache.put(self.controller_url, self.client_id, self.bearer, expires_at)
+        return self.bearer
+
+    def refresh_bearer_token(self, stale_bearer):
+        with self._token_lock:
+            # another thread may have refreshed while this one waited for the lock
+            if self.bearer != stale_bearer:
+                return self.bearer
+            if self.token_cache:
+                self.token_cache.invalidate(self.controller_url, self.client_id)
+            return self.get_bearer_token(force=True)
+
+    def _use_bearer(self, bearer, expires_at):
+        self.bearer = bearer
+        self.bearer_expires_at = expires_at
+        self.session.headers["Authorization"] = f"Bearer {bearer}"
+
+    def cached_inventory(self, name, fetch):
+        """Return fetch(), reusing the inventory cache's copy for this controller when there is one."""
+        if self.inventory_cache is None:
+            return fetch()
+        return self.inventory_cache.get(f"{self.controller_url}|{name}", fetch)
+
+    def invalidate_inventory(self, name=""):
+        if self.inventory_cache is not None:
+            self.inventory_cache.invalidate(f"{self.controller_url}|{name}")
+
+    def invalidate_response(self, path, method="GET", params=None, body=None):
+        """Drop a cached response, after a change the controller would otherwise be asked to confirm."""
+        if self.response_cache is not None:
+            self.response_cache.invalidate(self.response_cache.key(method, f"{self.controller_url}{path}", params, body))
+
+    def timeout_for(self, path):
+        for prefix, timeout in self.timeouts.items():
+            if path.startswith(prefix):
+                return timeout
+        return DEFAULT_TIMEOUT
+
+    def request(self, method, path, headers=None, **kwargs):
+        if "json" in kwargs:
+            headers = {"Content-Type": "application/json;charset=UTF-8", **(headers or {})}
+        kwargs.setdefault("timeout", self.timeout_for(path))
+        started = time.perf_counter()
+        endpoint = endpoint_name(path) if self.stats is not None else None
+
+        cache_key = cached = None
+        ttl = self.response_cache.ttl_for(path) if self.response_cache is not None else None
+        if ttl is not None:
+            cache_key = self.response_cache.key(method, f"{self.controller_url}{path}", kwargs.get("params"), kwargs.get("json"))
+            cached = self.response_cache.get(cache_key)
+            if cached is not None and self.response_cache.is_fresh(cached, ttl):
+                self.response_cache.count("hit")
+                if endpoint:
+                    self.stats.record_cached(self.name, endpoint)
+                return self._json_response(_cached_response(cached), endpoint)
+            validators = _validators(cached) if cached is not None else {}
+            if validators:
+                headers = {**validators, **(headers or {})}
+
+        authenticated = self.bearer is not None and path != TOKEN_PATH
+        if authenticated and self.bearer_expires_at and time.time() > self.bearer_expires_at - TOKEN_REFRESH_MARGIN:
+            self.refresh_bearer_token(self.bearer)
+
+        sent_bearer = self.bearer
+        retries = 0
+        try:
+            response, retries = self._send(method, path, headers, **kwargs)
+            if response.status_code == 401 and authenticated:
+                # the token was revoked or expired early, so get a new one and try once more
+                self.refresh_bearer_token(sent_bearer)
+                response, more_retries = self._send(method, path, headers, **kwargs)
+                retries += more_retries
+        except requests.exceptions.RequestException as e:
+            if endpoint:
+                self.stats.record(self.name, endpoint, time.perf_counter() - started, 0.0, "error", 0,
+                                  retries + getattr(e, "retries", 0))
+            # counted now, so a request whose token refresh failed doesn't count the token request's retries too
+            e.retries = 0
+            raise
+        if endpoint:
+            self.stats.record(self.name, endpoint, time.perf_counter() - started, response.elapsed.total_seconds(),
+                              response.status_code, len(response.content), retries)
+
+        if cached is not None and response.status_code == 304:
+            # unchanged since it was cached, so the cached body is current again
+            self.response_cache.count("revalidated")
+            if endpoint:
+                self.stats.record_cached(self.name, endpoint)
+            self.response_cache.put(cache_key, {**cached, "stored_at": time.time()})
+            return self._json_response(_cached_response(cached), endpoint)
+
+        # logged rather than printed, stdout carries the collected events. The token exchange's body carries
+        # the client secret and its response the bearer token, so neither is ever logged
+        secret = path == TOKEN_PATH
+        if self.debug:
+            logging.debug(f"Request URL: {response.request.url}\n"
+                          f"Request Headers: {_redacted(response.request.headers)}\n"
+                          f"Request Payload: {'<redacted>' if secret else response.request.body}\n"
+                          f"Response: {response.status_code} {'<redacted>' if secret and response.ok else response.text}")
+
+        if response.status_code >= 300:
+            message = [f"Error: {response.status_code} - {response.text}",
+                       f"Request header: {json.dumps(_redacted(response.request.headers), indent=2)}"]
+            if response.request.body and not secret:
+                message.append(f"Request body: {_decoded(response.request.body)}")
+            logging.error("\n".join(message))
+
+        response.raise_for_status()
+        if cache_key is not None:
+            self.response_cache.count("miss")
+            self.response_cache.put(cache_key, {
+                "url": response.url,
+                "stored_at": time.time(),
+                "status_code": response.status_code,
+                "headers": {name: response.headers[name] for name in ["Content-Type", "ETag", "Last-Modified"] if name in response.headers},
+                "content": response.text,
+            })
+        return self._json_response(response, endpoint)
+
+    def _json_response(self, response, endpoint):
+        """Have response.json() decode with the appd_json backend, adding its decode time to the endpoint's stats."""
+        def decode_json(**kwargs):
+            started = time.perf_counter()
+            data = appd_json.loads(response.content)
+            if endpoint:
+                self.stats.record_decode(self.name, endpoint, time.perf_counter() - started)
+            return data
+        response.json = decode_json
+        return response
+
+    def _send(self, method, path, headers, **kwargs):
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            if self.concurrency:
+                self.concurrency.acquire()
+            started = time.monotonic()
+            # anything that doesn't produce a response counts as the controller not coping
+            throttled, retry_after = True, None
+            try:
+                response = self.session.request(method, f"{self.controller_url}{path}", headers=headers, **kwargs)
+                throttled = response.status_code in THROTTLE_STATUSES
+                retry_after = _retry_after(response)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self.retries:
+                    e.retries = attempt
+                    raise
+                failure = str(e)
+            except requests.exceptions.RequestException as e:
+                # never retried, so the stats count only the retries actually made
+                e.retries = attempt
+                raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return response, attempt
+                failure = f"{response.status_code} {response.reason}"
+            finally:
+                if self.concurrency:
+                    self.concurrency.release(endpoint_name(path), started, throttled, retry_after)
+            # jittered so threads that failed together don't all retry together
+            delay = retry_after if retry_after is not None else random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+            attempt += 1
+            logging.warning(f"{method} {path} failed with {failure}, retry {attempt} of {self.retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+
+def add_client_arguments(parser):
+    """The options every script has for its controller client: rate limiting, retries, caches and stats."""
+    parser.add_argument("--rate-limit", type=float, default=None, help="Maximum requests per second sent to the controller")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="Times to retry a request that failed with 429, 5xx or a connection error, backing off exponentially with jitter or as Retry-After asks")
+    parser.add_argument("--no-adaptive-concurrency", action="store_true", help="Keep every worker's requests in flight even when the controller throttles or slows down")
+    parser.add_argument("--stats", choices=STATS_FORMATS, help="Report each controller endpoint's request count, timing, bytes and JSON decode time at the end of the run")
+    parser.add_argument("--stats-file", help="File to write the --stats report to instead of stderr, e.g. for the node exporter's textfile collector")
+    parser.add_argument("--token-cache", default=DEFAULT_TOKEN_CACHE, help="File to cache bearer tokens in between runs, or 'none' to disable")
+    parser.add_argument("--inventory-ttl", type=float, default=DEFAULT_INVENTORY_TTL, help="Seconds to reuse the controller's application inventory before fetching it again")
+    parser.add_argument("--inventory-snapshot", default=DEFAULT_INVENTORY_SNAPSHOT, help="File to keep the last known application inventory in, or 'none' to disable")
+    parser.add_argument("--response-cache-size", type=int, default=DEFAULT_RESPONSE_CACHE_SIZE, help="Responses from slow-changing endpoints to keep in memory, 0 to disable the response cache")
+    parser.add_argument("--response-cache-dir", help="Directory to also keep cached responses in between runs")
+    parser.add_argument("--refresh-inventory", action="store_true", help="Ignore any cached application inventory and fetch it again")
+
+
+def shared_from_args(args):
+    """The token, inventory and response caches and request stats add_client_arguments asked for, for clients to share."""
+    return {
+        "token_cache": None if args.token_cache == "none" else TokenCache(args.token_cache),
+        "inventory_cache": InventoryCache(args.inventory_ttl, None if args.inventory_snapshot == "none" else args.inventory_snapshot),
+        "response_cache": ResponseCache(args.response_cache_size, args.response_cache_dir) if args.response_cache_size > 0 else None,
+        "stats": RequestStats() if args.stats else None,
+    }
+
+
+def client_from_args(args, controller_url, client_id, client_secret, pool_size=DEFAULT_POOL_SIZE, rate_limit=None, name=None,
+                     shared=None):
+    """A ControllerClient set up as add_client_arguments asked, using the shared caches and stats when given."""
+    client = ControllerClient(controller_url, client_id, client_secret, pool_size=max(DEFAULT_POOL_SIZE, pool_size),
+                              rate_limit=rate_limit or args.rate_limit, retries=args.retries,
+                              adaptive_concurrency=not args.no_adaptive_concurrency, name=name, debug=args.debug,
+                              **(shared if shared is not None else shared_from_args(args)))
+    if args.refresh_inventory:
+        client.invalidate_inventory()
+    return client
+
+
+def fan_out(fn, items, workers=1, ordered=True):
+    """Run fn over items on a thread pool, yielding (item, future) pairs as they finish.
+
+    At most 2 * workers calls are in flight or finished but not yet consumed, so results never pile
+    up ahead of a slow consumer. With ordered=False pairs are yielded in completion order.
+    """
+    workers = max(1, workers)
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque((item, executor.submit(fn, item)) for item in islice(items, 2 * workers))
+        while pending:
+            if ordered:
+                item, future = pending.popleft()
+                wait([future])
+            else:
+                done, _ = wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+                item, future = next(entry for entry in pending if entry[1] in done)
+                pending.remove((item, future))
+            for next_item in islice(items, 1):
+                pending.append((next_item, executor.submit(fn, next_item)))
+            yield item, future
+
+
+def _retry_after(response):
+    """Seconds the controller asks to wait before trying again, from Retry-After as seconds or an HTTP date."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(MAX_RETRY_AFTER, max(0.0, seconds))
+
+
+def _validators(entry):
+    headers = entry["headers"]
+    validators = {}
+    if "ETag" in headers:
+        validators["If-None-Match"] = headers["ETag"]
+    if "Last-Modified" in headers:
+        validators["If-Modified-Since"] = headers["Last-Modified"]
+    return validators
+
+
+def _cached_response(entry):
+    response = requests.Response()
+    response.status_code = entry["status_code"]
+    response.url = entry["url"]
+    response.headers = CaseInsensitiveDict(entry["headers"])
+    response.encoding = "utf-8"
+    response._content = entry["content"].encode("utf-8")
+    return response
+
+
+def _redacted(headers):
+    return {name: "<redacted>" if name.lower() == "authorization" else value for name, value in headers.items()}
+
+
+def _decoded(body):
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+    try:
+        return json.dumps(json.loads(body), indent=2)
+    except ValueError:
+        return body
@@ -0,0 +1,38 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_BACKENDS = ["auto", "orjson", "json"]
+
+# orjson when it is installed, it decodes and encodes several times faster than the standard library, at the
+# cost of a higher peak memory while several large responses are decoded at once
+backend = "orjson" if orjson else "json"
+
+
+def set_backend(name):
+    global backend
+    if name == "auto":
+        name = "orjson" if orjson else "json"
+    if name == "orjson" and orjson is None:
+        raise ValueError("the orjson JSON backend needs the orjson package, pip install orjson")
+    backend = name
+
+
+def loads(data):
+    if backend == "orjson":
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(value, indent=False):
+    """Compact JSON, or indented by 2 like json.dumps(value, indent=2), as a str."""
+    if backend == "orjson":
+        # machine ids key some collector output as ints, which the standard library turns into strings too
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(value, option=option).decode()
+    if indent:
+        return json.dumps(value, indent=2)
+    return json.dumps(value, separators=(",", ":"))
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import Counter
+
+import requests
+
+from appd_client import fan_out
+
+
+def get_applications(client, refresh=False):
+    """The controller's applications, from the inventory cache unless refresh asks for them again."""
+    if refresh:
+        client.invalidate_inventory("rest/applications")
+    return client.cached_inventory("rest/applications",
+                                   lambda: client.get("/controller/rest/applications?output=JSON").json())
+
+
+class ApplicationIndex:
+    """Application name to id lookups over one download of the controller's inventory."""
+
+    def __init__(self, applications):
+        self.ids = {app["name"]: app["id"] for app in applications}
+        self.folded_names = {}
+        for app in applications:
+            self.folded_names.setdefault(app["name"].casefold(), []).append(app["name"])
+
+    def lookup(self, appname):
+        if appname in self.ids:
+            return self.ids[appname]
+        matches = self.folded_names.get(appname.casefold(), [])
+        if len(matches) == 1:
+            print(f"Application \"{appname}\" not found, using \"{matches[0]}\" which differs only in case")
+            return self.ids[matches[0]]
+        if len(matches) > 1:
+            print(f"Application \"{appname}\" not found, and it matches {matches} ignoring case, so skipping it")
+        return None
+
+
+def resolve_applications(client, app_names):
+    """Map application names to (name, id) pairs, reporting and returning the names the controller doesn't have.
+
+    Names missing from a cached inventory are looked up once more in a fresh one, as the application
+    may have been created since it was cached.
+    """
+    index = ApplicationIndex(get_applications(client))
+    applications = []
+    missing = []
+    for app_name in app_names:
+        app_id = index.ids.get(app_name)
+        if app_id is None:
+            missing.append(app_name)
+        else:
+            applications.append((app_name, app_id))
+    if missing:
+        index = ApplicationIndex(get_applications(client, refresh=True))
+    still_missing = []
+    for app_name in missing:
+        app_id = index.lookup(app_name)
+        if app_id is None:
+            still_missing.append(app_name)
+        else:
+            applications.append((app_name, app_id))
+    missing = still_missing
+    if missing:
+        print(f"Applications not found on the controller {client.controller_url}: {', '.join(missing)}")
+    return applications, missing
+
+
+class RolloutJournal:
+    """Append-only file of each target's outcome, so an interrupted rollout can be resumed.
+
+    The first line identifies the rollout (controller and change), and resuming a journal written
+    for a different rollout is refused. Targets recorded as changed or unchanged are skipped on
+    resume, failed ones are tried again.
+    """
+
+    def __init__(self, path, rollout, resume=False):
+        self.path = path
+        self.rollout = hashlib.sha256(json.dumps(rollout, sort_keys=True).encode()).hexdigest()
+        self.done = set()
+        entries = self._read() if resume else []
+        if entries and entries[0].get("rollout") != self.rollout:
+            raise ValueError(f"journal {path} was written for a different controller or change, it can't be resumed")
+        for entry in entries[1:]:
+            if entry.get("result") in ["changed", "unchanged"]:
+                self.done.add(self._key(entry["id"]))
+
+        self.resumed = bool(entries)
+        # opened on the first outcome, so a run that stops before doing anything keeps the old journal
+        self.file = None
+
+    @staticmethod
+    def _key(target_id):
+        # ids go through JSON in the journal, so tuples come back as lists
+        return json.dumps(target_id)
+
+    def _read(self):
+        entries = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # the last line is cut short if the run died while writing it
+                        pass
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _append(self, entry):
+        if self.file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self.file = open(self.path, "a" if self.resumed else "w")
+            if not self.resumed:
+                self._append({"rollout": self.rollout, "started_at": time.time()})
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def completed(self, target_id):
+        return self._key(target_id) in self.done
+
+    def record(self, result):
+        if self.path is None:
+            return
+        try:
+            self._append(dict(result, recorded_at=time.time()))
+        except OSError as e:
+            # the rollout itself goes on, it just can't be resumed
+            logging.warning(f"Not journaling to {self.path}, it can't be written: {e}")
+            self.path = None
+            try:
+                self.close()
+            except OSError:
+                self.file = None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def add_journal_arguments(parser, default_journal, noun="applications"):
+    parser.add_argument("--journal", default=default_journal, help=f"File recording the outcome for each of the {noun} as it happens, or 'none' to disable")
+    parser.add_argument("--resume", action="store_true", help=f"Skip the {noun} the journal records as done by an earlier run of the same change")
+
+
+def open_journal(args, rollout):
+    """The RolloutJournal add_journal_arguments asked for, None for a plan or without one; exits if it can't be resumed."""
+    if args.journal == "none" or args.plan:
+        return None
+    try:
+        return RolloutJournal(args.journal, rollout, args.resume)
+    except ValueError as e:
+        print(f"Can't resume: {e}")
+        exit(1)
+
+
+def confirm_all_applications(controller_url, plan=False):
+    # a plan never writes to the controller, so it doesn't need the confirmation
+    confirmation = "YES" if plan else input(f"Please confirm with a 'YES' if you intended to run this for all applications on the controller {controller_url}: ")
+    if confirmation != "YES":
+        print("That was not a confirmation, so exiting")
+        exit(1)
+    print("Confirmed")
+
+
+def run_rollout(update, targets, workers=1, plan=False, noun="applications", journal=None):
+    """Call update(id) for (name, id) targets on up to workers threads, returning a result record per target.
+
+    update returns the changes it made (or would make, with plan) as diff lines, empty when the
+    target was already up to date. With a journal, targets it has already completed are skipped and
+    every outcome is recorded in it as soon as it is known.
+    """
+    if journal is not None:
+        targets = list(targets)
+        remaining = [target for target in targets if not journal.completed(target[1])]
+        if len(remaining) < len(targets):
+            print(f"Resuming from {journal.path}, {len(targets) - len(remaining)} {noun} already done")
+        targets = remaining
+
+    results = []
+    for (name, target_id), future in fan_out(lambda target: update(target[1]), targets, workers, ordered=False):
+        try:
+            diff = future.result()
+            result = {"target": name, "id": target_id, "result": "changed" if diff else "unchanged", "diff": diff}
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            result = {"target": name, "id": target_id, "result": "failed", "error": str(e)}
+        print(f"\"{name}\": {result['result']}" + (f" - {result['error']}" if "error" in result else ""))
+        for line in result.get("diff", []):
+            print(f"    {line}")
+        if journal is not None:
+            journal.record(result)
+        results.append(result)
+
+    counts = Counter(result["result"] for result in results)
+    print(f"{len(results)} {noun}: {counts['changed']} {'to change' if plan else 'changed'}, "
+          f"{counts['unchanged']} unchanged, {counts['failed']} failed" + (" (plan only, nothing was saved)" if plan else ""))
+    return results
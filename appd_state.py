@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from appd_cache import DEFAULT_CACHE_DIR
+
+DEFAULT_STATE_DB = os.path.join(DEFAULT_CACHE_DIR, "collector-state.sqlite")
+DEFAULT_FULL_SNAPSHOT_INTERVAL = 24 * 60 * 60
+
+# fields that differ on every poll without the entity changing, left out of the hash
+VOLATILE_FIELDS = {"deepLink"}
+
+
+def record_hash(record):
+    stable = {name: value for name, value in record.items() if name not in VOLATILE_FIELDS}
+    return hashlib.sha1(json.dumps(stable, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+
+class PollFailures:
+    """What a collector failed to collect during one poll, filled in while it yields its records.
+
+    A poll with failures is incomplete: entities it didn't yield may still exist, and the entities in
+    partial yielded records only part of their data.
+    """
+
+    def __init__(self):
+        self.scopes = []
+        self.partial = set()
+
+    def add(self, scope, partial=None):
+        """Record a failed request for scope, e.g. "application 17"; partial is the entity id of a record yielded anyway."""
+        self.scopes.append(scope)
+        if partial is not None:
+            self.partial.add(json.dumps(partial))
+
+    def __bool__(self):
+        return bool(self.scopes)
+
+
+class ChangeTracker:
+    """A hash of every entity last emitted per controller and collector, kept in SQLite between polls.
+
+    changes() passes on only the records that are new or changed since the last poll, followed by a
+    "removed" record for every entity that is gone. Every full_snapshot_interval seconds a poll passes
+    on everything, unchanged records included, so downstream can rebuild its state from one poll.
+    """
+
+    def __init__(self, path=DEFAULT_STATE_DB, full_snapshot_interval=DEFAULT_FULL_SNAPSHOT_INTERVAL):
+        self.path = path
+        self.full_snapshot_interval = full_snapshot_interval
+        os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS entities (scope TEXT, data_type TEXT, entity_id TEXT, hash TEXT,"
+                         " PRIMARY KEY (scope, data_type, entity_id))")
+            conn.execute("CREATE TABLE IF NOT EXISTS snapshots (scope TEXT, data_type TEXT, taken_at REAL,"
+                         " PRIMARY KEY (scope, data_type))")
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # a connection per call, since daemon collectors poll from their own threads
+        return sqlite3.connect(self.path, timeout=60)
+
+    def changes(self, scope, data_type, records, key_field, failures=None):
+        """Yield the records worth emitting, each with a "change" field of new, changed, unchanged or removed.
+
+        The state is only updated once records is exhausted, so a poll that fails part way through
+        is compared against the same previous state next time. When failures, the PollFailures the
+        collector filled in, is set once records is exhausted, the poll is incomplete: nothing is
+        removed, partial records are skipped, and entities without a complete record keep their
+        previous hash.
+        """
+        conn = self._connect()
+        try:
+            previous = dict(conn.execute("SELECT entity_id, hash FROM entities WHERE scope = ? AND data_type = ?",
+                                         (scope, data_type)))
+            row = conn.execute("SELECT taken_at FROM snapshots WHERE scope = ? AND data_type = ?",
+                               (scope, data_type)).fetchone()
+            full = row is None or time.time() - row[0] >= self.full_snapshot_interval
+
+            seen = {}
+            for record in records:
+                # ids are stored as JSON so removed records get them back with their original type
+                entity_id = json.dumps(record[key_field])
+                if failures is not None and entity_id in failures.partial:
+                    continue
+                digest = record_hash(record)
+                seen[entity_id] = digest
+                if entity_id not in previous:
+                    change = "new"
+                elif previous[entity_id] != digest:
+                    change = "changed"
+                elif full:
+                    change = "unchanged"
+                else:
+                    continue
+                yield {**record, "change": change}
+            complete = not failures
+            if complete:
+                for entity_id in previous.keys() - seen.keys():
+                    yield {key_field: json.loads(entity_id), "change": "removed"}
+            else:
+                seen = {**previous, **seen}
+
+            with conn:
+                conn.execute("DELETE FROM entities WHERE scope = ? AND data_type = ?", (scope, data_type))
+                conn.executemany("INSERT INTO entities VALUES (?, ?, ?, ?)",
+                                 [(scope, data_type, entity_id, digest) for entity_id, digest in seen.items()])
+                # an incomplete poll doesn't count as the full snapshot, the next one tries again
+                if full and complete:
+                    conn.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)", (scope, data_type, time.time()))
+        finally:
+            conn.close()
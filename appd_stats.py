@@ -0,0 +1,145 @@
+import os
+import re
+import sys
+import threading
+from collections import Counter
+
+STATS_FORMATS = ["table", "prometheus"]
+METRIC_PREFIX = "appdynamics_controller"
+
+# numeric path segments are entity ids, folded so each endpoint aggregates into one row
+ID_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+
+def endpoint_name(path):
+    """The path without /controller/, its query or entity ids, e.g. restui/v1/bt/listViewDataByColumnsV2."""
+    path = path.split("?", 1)[0]
+    if path.startswith("/controller/"):
+        path = path[len("/controller/"):]
+    return ID_SEGMENT.sub("/{id}", path)
+
+
+class EndpointStats:
+    __slots__ = ("requests", "errors", "retries", "cached", "seconds", "max_seconds", "first_byte_seconds",
+                 "bytes", "decodes", "decode_seconds", "statuses")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.cached = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.first_byte_seconds = 0.0
+        self.bytes = 0
+        self.decodes = 0
+        self.decode_seconds = 0.0
+        self.statuses = Counter()
+
+
+class RequestStats:
+    """Timing and size of every controller request, aggregated per controller and endpoint, shared by every client.
+
+    Wall time covers retries and token refreshes, time to first byte is the last attempt's time to the
+    response headers. Responses served from the response cache, fresh or revalidated with a 304, also
+    count as cached.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def _endpoint(self, controller, endpoint):
+        stats = self.endpoints.get((controller, endpoint))
+        if stats is None:
+            stats = self.endpoints.setdefault((controller, endpoint), EndpointStats())
+        return stats
+
+    def record(self, controller, endpoint, seconds, first_byte_seconds, status, size, retries):
+        with self._lock:
+            stats = self._endpoint(controller, endpoint)
+            stats.requests += 1
+            stats.retries += retries
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.first_byte_seconds += first_byte_seconds
+            stats.bytes += size
+            stats.statuses[status] += 1
+            if status == "error" or status >= 400:
+                stats.errors += 1
+
+    def record_cached(self, controller, endpoint):
+        with self._lock:
+            self._endpoint(controller, endpoint).cached += 1
+
+    def record_decode(self, controller, endpoint, seconds):
+        with self._lock:
+            stats = self._endpoint(controller, endpoint)
+            stats.decodes += 1
+            stats.decode_seconds += seconds
+
+    def table(self):
+        with self._lock:
+            rows = sorted(self.endpoints.items(), key=lambda item: item[1].seconds, reverse=True)
+            # the controller only gets a column when there is more than one
+            if len({controller for controller, _ in self.endpoints}) > 1:
+                rows = [(f"{controller} {endpoint}", stats) for (controller, endpoint), stats in rows]
+            else:
+                rows = [(endpoint, stats) for (_, endpoint), stats in rows]
+            width = max([len("endpoint")] + [len(endpoint) for endpoint, _ in rows])
+            lines = [f"{'endpoint':<{width}} {'requests':>8} {'errors':>6} {'retries':>7} {'cached':>6} {'avg ms':>8} "
+                     f"{'max ms':>8} {'ttfb ms':>8} {'MB':>8} {'decode ms':>9}  statuses"]
+            for endpoint, stats in rows:
+                requests = max(1, stats.requests)
+                statuses = " ".join(f"{status}:{count}" for status, count in sorted(stats.statuses.items(), key=str))
+                lines.append(f"{endpoint:<{width}} {stats.requests:>8} {stats.errors:>6} {stats.retries:>7} {stats.cached:>6} "
+                             f"{stats.seconds / requests * 1000:>8.1f} {stats.max_seconds * 1000:>8.1f} "
+                             f"{stats.first_byte_seconds / requests * 1000:>8.1f} {stats.bytes / 1e6:>8.2f} "
+                             f"{stats.decode_seconds * 1000:>9.1f}  {statuses}")
+            total = sum(stats.seconds for _, stats in rows)
+            first_byte = sum(stats.first_byte_seconds for _, stats in rows)
+            decode = sum(stats.decode_seconds for _, stats in rows)
+        lines.append(f"{sum(stats.requests for _, stats in rows)} requests: {total:.2f}s in requests, "
+                     f"{first_byte:.2f}s waiting for the controller to answer, {decode:.2f}s decoding JSON")
+        return "\n".join(lines) + "\n"
+
+    def prometheus(self):
+        metrics = [
+            ("requests_total", "counter", "Controller requests", lambda stats: stats.requests),
+            ("request_errors_total", "counter", "Controller requests that failed or answered 4xx/5xx", lambda stats: stats.errors),
+            ("request_retries_total", "counter", "Controller request retries", lambda stats: stats.retries),
+            ("cached_responses_total", "counter", "Responses served from the response cache", lambda stats: stats.cached),
+            ("request_seconds_total", "counter", "Wall time of controller requests, retries included", lambda stats: stats.seconds),
+            ("request_seconds_max", "gauge", "Longest controller request", lambda stats: stats.max_seconds),
+            ("first_byte_seconds_total", "counter", "Time to the controller's response headers", lambda stats: stats.first_byte_seconds),
+            ("response_bytes_total", "counter", "Response body bytes, after decompression", lambda stats: stats.bytes),
+            ("json_decodes_total", "counter", "Response bodies decoded from JSON", lambda stats: stats.decodes),
+            ("json_decode_seconds_total", "counter", "Time decoding response bodies from JSON", lambda stats: stats.decode_seconds),
+        ]
+        lines = []
+        with self._lock:
+            for name, kind, help_text, value in metrics:
+                lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+                lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+                for (controller, endpoint), stats in sorted(self.endpoints.items()):
+                    lines.append(f'{METRIC_PREFIX}_{name}{{controller="{controller}",endpoint="{endpoint}"}} {value(stats)}')
+            lines.append(f"# HELP {METRIC_PREFIX}_responses_total Controller responses by status")
+            lines.append(f"# TYPE {METRIC_PREFIX}_responses_total counter")
+            for (controller, endpoint), stats in sorted(self.endpoints.items()):
+                for status, count in sorted(stats.statuses.items(), key=str):
+                    lines.append(f'{METRIC_PREFIX}_responses_total{{controller="{controller}",endpoint="{endpoint}",status="{status}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, stats_format, path=None):
+        """Write the report to path, or to stderr so it never mixes with events on stdout."""
+        report = self.prometheus() if stats_format == "prometheus" else self.table()
+        if not path:
+            sys.stderr.write(report)
+            return
+        # write to the side and rename, so a textfile collector never reads a half written file
+        with self._write_lock:
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "w") as f:
+                f.write(report)
+            os.replace(temp_path, path)
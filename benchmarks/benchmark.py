@@ -0,0 +1,374 @@
+"""Benchmarks for the controller utility scripts, run against a local mock controller.
+
+usage: python benchmarks/benchmark.py bt-workers [--apps 200] [--latency 0.05]
+       python benchmarks/benchmark.py output-format [--apps 400] [--bts 200]
+       python benchmarks/benchmark.py server-chunks [--machines 12000] [--latency-per-id 0.0002]
+       python benchmarks/benchmark.py server-format [--machines 12000]
+       python benchmarks/benchmark.py database-batching [--databases 2000]
+       python benchmarks/benchmark.py collectors [--apps 1000] [--machines 20000] [--error-rate 0.01]
+       python benchmarks/benchmark.py exclude-rollout [--apps 2000] [--workers 4 16 32]
+       python benchmarks/benchmark.py throttling [--max-in-flight 8] [--workers 32]
+       python benchmarks/benchmark.py json [--bts 2000] [--machines 500] [--fixtures recorded.json]
+"""
+import argparse
+import gc
+import importlib.util
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+
+from mock_controller import MockController
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import appd_json
+from appd_client import ControllerClient, DEFAULT_POOL_SIZE
+
+COLLECTORS = ["applications", "databases", "servers", "business_transactions", "security", "attacks", "vulnerabilities"]
+
+# runs a script as __main__, then writes its peak RSS in kB to the file named by its first argument. ru_maxrss
+# from wait4 won't do: Linux carries the benchmark process's own peak over into a child through exec
+PEAK_RSS_WRAPPER = """
+import atexit, os, runpy, sys
+def report(path=sys.argv[1]):
+    with open("/proc/self/status") as status, open(path, "w") as out:
+        out.write(next(line.split()[1] for line in status if line.startswith("VmHWM:")))
+atexit.register(report)
+sys.argv = sys.argv[2:]
+sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+ScriptRun = namedtuple("ScriptRun", ["first_byte", "elapsed", "peak_rss", "written", "lines", "returncode"])
+
+
+def load_script(file_name):
+    module_name = os.path.splitext(file_name)[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(REPO_ROOT, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def connect(controller, pool_size=DEFAULT_POOL_SIZE, **kwargs):
+    client = ControllerClient(controller.url, "mock-client", "mock-secret", pool_size=pool_size, **kwargs)
+    client.get_bearer_token()
+    return client
+
+
+def run_script(controller, file_name, arguments, input=None, check=True):
+    """Run a script against the mock controller and measure it from the outside.
+
+    Returns a ScriptRun with seconds to the first byte on stdout, total seconds, peak RSS in MB,
+    bytes and lines written and the exit status. input is written to the script's stdin.
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".sh") as config, tempfile.NamedTemporaryFile("r") as peak:
+        config.write(f'APPD_CONTROLLER_URL="{controller.url}/"\nAPPD_CLIENT_ID="mock-client"\nAPPD_CLIENT_SECRET="mock-secret"\n')
+        config.flush()
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-c", PEAK_RSS_WRAPPER, peak.name, os.path.join(REPO_ROOT, file_name), "-c", config.name,
+                                    "--token-cache", "none", "--inventory-snapshot", "none", *arguments],
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if input:
+            process.stdin.write(input.encode())
+        process.stdin.close()
+        chunk = process.stdout.read(1)
+        first_byte = time.perf_counter() - start
+        written = lines = 0
+        while chunk:
+            written += len(chunk)
+            lines += chunk.count(b"\n")
+            chunk = process.stdout.read(65536)
+        process.wait()
+        elapsed = time.perf_counter() - start
+        peak_rss = int(peak.read() or 0) / 1024
+    if check and process.returncode != 0:
+        raise RuntimeError(f"{file_name} {' '.join(arguments)} exited with {process.returncode}")
+    return ScriptRun(first_byte, elapsed, peak_rss, written, lines, process.returncode)
+
+
+def bench_output_format(args):
+    with MockController(apps=args.apps, bts_per_app=args.bts, latency=args.latency) as controller:
+        print(f"business_transactions: {args.apps} applications x {args.bts} BTs, {args.workers} workers")
+        print(f"{'format':>8} {'first event s':>14} {'total s':>8} {'peak RSS MB':>12} {'MB written':>11}")
+        for output_format in ["json", "ndjson"]:
+            run = run_script(controller, "splunk-itsi-applications.py",
+                             ["-t", "business_transactions", "-w", str(args.workers), "-f", output_format])
+            print(f"{output_format:>8} {run.first_byte:>14.2f} {run.elapsed:>8.2f} {run.peak_rss:>12.1f} {run.written / 1e6:>11.1f}")
+
+
+def bench_bt_workers(args):
+    splunk = load_script("splunk-itsi-applications.py")
+    with MockController(apps=args.apps, bts_per_app=args.bts, latency=args.latency) as controller:
+        print(f"{args.apps} applications, {args.bts} BTs each, {args.latency * 1000:.0f} ms per request")
+        print(f"{'workers':>8} {'seconds':>9} {'speedup':>8}")
+        baseline = None
+        for workers in args.workers:
+            with connect(controller, max(DEFAULT_POOL_SIZE, workers)) as client:
+                start = time.perf_counter()
+                btData = splunk.getBusinessTransactionsSummary(client, workers)
+                elapsed = time.perf_counter() - start
+            assert len(btData) == args.apps
+            baseline = baseline or elapsed
+            print(f"{workers:>8} {elapsed:>9.2f} {baseline / elapsed:>7.1f}x")
+
+
+def bench_server_chunks(args):
+    splunk = load_script("splunk-itsi-applications.py")
+    with MockController(machines=args.machines, latency=args.latency, latency_per_id=args.latency_per_id) as controller:
+        print(f"{args.machines} machines, {args.latency * 1000:.0f} ms per request + {args.latency_per_id * 1e6:.0f} us per machine id")
+        print(f"{'chunk size':>10} {'workers':>8} {'first server s':>15} {'total s':>8}")
+        for chunk_size, workers in [(args.machines, 1)] + [(size, args.workers) for size in args.chunk_sizes]:
+            with connect(controller, max(DEFAULT_POOL_SIZE, workers)) as client:
+                start = time.perf_counter()
+                first = None
+                servers = 0
+                for _ in splunk.iterServerSummary(client, workers, chunk_size):
+                    first = first or time.perf_counter() - start
+                    servers += 1
+                elapsed = time.perf_counter() - start
+            assert servers == args.machines
+            print(f"{chunk_size:>10} {workers:>8} {first:>15.2f} {elapsed:>8.2f}")
+
+
+def retained_mb(collect):
+    """MB still allocated once collect() has returned, with its result kept alive."""
+    gc.collect()
+    tracemalloc.start()
+    result = collect()
+    gc.collect()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return retained / 1e6
+
+
+def bench_server_format(args):
+    splunk = load_script("splunk-itsi-applications.py")
+    with MockController(machines=args.machines, latency=args.latency) as controller:
+        print(f"servers: {args.machines} machines x 9 metrics, {args.workers} workers")
+        print(f"{'server format':>14} {'output':>7} {'total s':>8} {'peak RSS MB':>12} {'MB written':>11}")
+        for server_format in ["nested", "flat"]:
+            for output_format in ["json", "ndjson"]:
+                run = run_script(controller, "splunk-itsi-applications.py",
+                                 ["-t", "servers", "-w", str(args.workers), "-f", output_format, "--server-format", server_format])
+                print(f"{server_format:>14} {output_format:>7} {run.elapsed:>8.2f} {run.peak_rss:>12.1f} {run.written / 1e6:>11.1f}")
+
+        print(f"{'server format':>14} {'retained MB':>12}")
+        for server_format in ["nested", "flat"]:
+            with connect(controller, max(DEFAULT_POOL_SIZE, args.workers)) as client:
+                retained = retained_mb(lambda: splunk.getServerSummary(client, args.workers, compact=server_format == "flat"))
+            print(f"{server_format:>14} {retained:>12.1f}")
+
+
+def bench_database_batching(args):
+    splunk = load_script("splunk-itsi-applications.py")
+    with MockController(databases=args.databases, latency=args.latency, latency_per_id=args.latency_per_id) as controller:
+        print(f"{args.databases} databases, {args.latency * 1000:.0f} ms per request")
+        print(f"{'chunk size':>10} {'workers':>8} {'data points':>12} {'summary':>8} {'seconds':>8} {'MB received':>12} {'MB kept':>8}")
+        for chunk_size, workers, data_points, summarize in [
+                (args.databases, 1, 1440, False),
+                (args.chunk_size, args.workers, 1440, False),
+                (args.chunk_size, args.workers, 1440, True),
+                (args.chunk_size, args.workers, args.data_points, True)]:
+            with connect(controller, max(DEFAULT_POOL_SIZE, workers)) as client:
+                sent = controller.bytes_sent
+                start = time.perf_counter()
+                data = splunk.getDatabaseSummary(client, workers, chunk_size, data_points, summarize)
+                elapsed = time.perf_counter() - start
+            assert len(data["data"]) == args.databases
+            kept = len(json.dumps(data))
+            print(f"{chunk_size:>10} {workers:>8} {data_points:>12} {str(summarize):>8} {elapsed:>8.2f} "
+                  f"{(controller.bytes_sent - sent) / 1e6:>12.1f} {kept / 1e6:>8.1f}")
+
+
+def bench_collectors(args):
+    with MockController(apps=args.apps, bts_per_app=args.bts, machines=args.machines, databases=args.databases,
+                        latency=args.latency, error_rate=args.error_rate) as controller:
+        print(f"{args.apps} applications x {args.bts} BTs, {args.machines} machines, {args.databases} databases, "
+              f"{args.latency * 1000:.0f} ms per request, {args.error_rate:.1%} of requests failed, {args.workers} workers")
+        print(f"{'collector':>22} {'events':>8} {'total s':>8} {'events/s':>9} {'peak RSS MB':>12} {'requests':>9} {'failed':>7}")
+        for collector in args.collectors:
+            requests, errors = controller.requests, controller.errors
+            run = run_script(controller, "splunk-itsi-applications.py", ["-t", collector, "-w", str(args.workers), "-f", "ndjson"])
+            print(f"{collector:>22} {run.lines:>8} {run.elapsed:>8.2f} {run.lines / run.elapsed:>9.0f} {run.peak_rss:>12.1f} "
+                  f"{controller.requests - requests:>9} {controller.errors - errors:>7}")
+
+
+def bench_exclude_rollout(args):
+    print(f"add-call-graph-exclude-config.py -a ALL: {args.apps} applications, {args.latency * 1000:.0f} ms per request, "
+          f"{args.error_rate:.1%} of requests failed")
+    print(f"{'workers':>8} {'total s':>8} {'apps/s':>7} {'peak RSS MB':>12} {'requests':>9} {'saves':>6} {'failed':>7} {'exit':>5}")
+    for workers in args.workers:
+        # a fresh controller each run, so every run has every application to change
+        with MockController(apps=args.apps, latency=args.latency, error_rate=args.error_rate) as controller:
+            run = run_script(controller, "add-call-graph-exclude-config.py",
+                             ["-a", "ALL", "-w", str(workers), "--journal", "none"], input="YES\n", check=False)
+            print(f"{workers:>8} {run.elapsed:>8.2f} {args.apps / run.elapsed:>7.1f} {run.peak_rss:>12.1f} {controller.requests:>9} "
+                  f"{len(controller.saved_configs):>6} {controller.errors:>7} {run.returncode:>5}")
+
+
+def bench_throttling(args):
+    splunk = load_script("splunk-itsi-applications.py")
+    print(f"business_transactions: {args.apps} applications, {args.workers} workers, controller serving {args.max_in_flight} "
+          f"requests at once, Retry-After {args.retry_after}")
+    print(f"{'concurrency':>12} {'seconds':>8} {'apps':>6} {'requests':>9} {'429s':>6}")
+    for adaptive in [False, True]:
+        with MockController(apps=args.apps, latency=args.latency, max_in_flight=args.max_in_flight,
+                            retry_after=args.retry_after) as controller:
+            with connect(controller, args.workers, adaptive_concurrency=adaptive) as client:
+                start = time.perf_counter()
+                btData = splunk.getBusinessTransactionsSummary(client, args.workers)
+                elapsed = time.perf_counter() - start
+            print(f"{'adaptive' if adaptive else 'fixed':>12} {elapsed:>8.2f} {len(btData):>6} {controller.requests:>9} "
+                  f"{controller.throttled:>6}")
+
+
+def best_seconds(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_json(args):
+    splunk = load_script("splunk-itsi-applications.py")
+    if args.fixtures:
+        with open(args.fixtures) as f:
+            fixtures = json.load(f)
+    else:
+        controller = MockController(bts_per_app=args.bts)
+        fixtures = {
+            "bt/listViewDataByColumnsV2": controller.bt_list({"requestFilter": {"queryParams": {"applicationIds": [1]}}}, {}),
+            "sim/v2/user/metrics/query/machines": controller.machine_metrics(
+                {"ids": list(range(1, args.machines + 1)), "rollups": [1, 1440], "metricNames": list(splunk.SERVER_METRIC_COLUMNS)}, {}),
+        }
+    # how each collector projects a payload of the endpoint, when it does
+    projections = {
+        "bt/listViewDataByColumnsV2": lambda data: {**data, "btListEntries": [splunk.project_bt_entry(item) for item in data["btListEntries"]]},
+        "sim/v2/user/metrics/query/machines": lambda data: {"data": {rollup: {
+            machine_id: {**machine, "metricData": splunk.project_metric_data(machine.get("metricData", {}))}
+            for machine_id, machine in machines.items()} for rollup, machines in data["data"].items()}},
+    }
+    backends = ["json", "orjson"] if appd_json.orjson else ["json"]
+
+    print(f"{'payload':>36} {'backend':>7} {'MB':>6} {'decode ms':>10} {'encode ms':>10} {'indent ms':>10} {'projected MB':>13}")
+    for name, payload in fixtures.items():
+        content = json.dumps(payload, separators=(",", ":")).encode()
+        for backend in backends:
+            appd_json.set_backend(backend)
+            data = appd_json.loads(content)
+            decode = best_seconds(lambda: appd_json.loads(content), args.repeat)
+            encode = best_seconds(lambda: appd_json.dumps(data), args.repeat)
+            indent = best_seconds(lambda: appd_json.dumps(data, indent=True), args.repeat)
+            projected = len(appd_json.dumps(projections[name](data))) if name in projections else len(content)
+            print(f"{name:>36} {backend:>7} {len(content) / 1e6:>6.2f} {decode * 1000:>10.1f} {encode * 1000:>10.1f} "
+                  f"{indent * 1000:>10.1f} {projected / 1e6:>13.2f}")
+    appd_json.set_backend("auto")
+
+    with MockController(apps=args.apps, bts_per_app=args.bts // 10, machines=args.machines * 10, latency=args.latency) as controller:
+        print(f"{'collector':>22} {'backend':>7} {'projection':>10} {'total s':>8} {'peak RSS MB':>12} {'MB written':>11}")
+        for collector in ["business_transactions", "servers"]:
+            for backend in backends:
+                for projection in [False, True]:
+                    run = run_script(controller, "splunk-itsi-applications.py",
+                                     ["-t", collector, "-w", str(args.workers), "--json-backend", backend]
+                                     + (["--projection"] if projection else []))
+                    print(f"{collector:>22} {backend:>7} {str(projection):>10} {run.elapsed:>8.2f} {run.peak_rss:>12.1f} "
+                          f"{run.written / 1e6:>11.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Controller utility benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    bt_workers = subparsers.add_parser("bt-workers", help="Business transaction collection wall time by worker count")
+    bt_workers.add_argument("--apps", type=int, default=200, help="Number of mock applications")
+    bt_workers.add_argument("--bts", type=int, default=20, help="Business transactions per application")
+    bt_workers.add_argument("--latency", type=float, default=0.05, help="Mock controller latency per request, in seconds")
+    bt_workers.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32], help="Worker counts to measure")
+    bt_workers.set_defaults(func=bench_bt_workers)
+
+    output_format = subparsers.add_parser("output-format", help="Peak RSS and time to first event, json vs ndjson")
+    output_format.add_argument("--apps", type=int, default=400, help="Number of mock applications")
+    output_format.add_argument("--bts", type=int, default=200, help="Business transactions per application")
+    output_format.add_argument("--latency", type=float, default=0.01, help="Mock controller latency per request, in seconds")
+    output_format.add_argument("--workers", type=int, default=8, help="Workers passed to the script")
+    output_format.set_defaults(func=bench_output_format)
+
+    server_chunks = subparsers.add_parser("server-chunks", help="Server collection time by machine id chunk size")
+    server_chunks.add_argument("--machines", type=int, default=12000, help="Number of mock machines")
+    server_chunks.add_argument("--latency", type=float, default=0.05, help="Mock controller latency per request, in seconds")
+    server_chunks.add_argument("--latency-per-id", type=float, default=0.0002, help="Extra latency per machine id in a request, in seconds")
+    server_chunks.add_argument("--chunk-sizes", type=int, nargs="+", default=[2000, 500, 100], help="Chunk sizes to measure")
+    server_chunks.add_argument("--workers", type=int, default=8, help="Workers for the chunked runs")
+    server_chunks.set_defaults(func=bench_server_chunks)
+
+    server_format = subparsers.add_parser("server-format", help="Peak RSS and output size of nested vs flat server records")
+    server_format.add_argument("--machines", type=int, default=12000, help="Number of mock machines")
+    server_format.add_argument("--latency", type=float, default=0.01, help="Mock controller latency per request, in seconds")
+    server_format.add_argument("--workers", type=int, default=8, help="Workers passed to the script")
+    server_format.set_defaults(func=bench_server_format)
+
+    database_batching = subparsers.add_parser("database-batching", help="Database collection time and bytes by batching, data points and summaries")
+    database_batching.add_argument("--databases", type=int, default=2000, help="Number of mock databases")
+    database_batching.add_argument("--latency", type=float, default=0.05, help="Mock controller latency per request, in seconds")
+    database_batching.add_argument("--latency-per-id", type=float, default=0.0001, help="Extra latency per database id and 100 data points, in seconds")
+    database_batching.add_argument("--chunk-size", type=int, default=200, help="Database ids per request for the batched runs")
+    database_batching.add_argument("--workers", type=int, default=8, help="Workers for the batched runs")
+    database_batching.add_argument("--data-points", type=int, default=15, help="Reduced data points per metric")
+    database_batching.set_defaults(func=bench_database_batching)
+
+    collectors = subparsers.add_parser("collectors", help="Throughput, wall time and peak RSS of every collector")
+    collectors.add_argument("--apps", type=int, default=1000, help="Number of mock applications")
+    collectors.add_argument("--bts", type=int, default=20, help="Business transactions per application")
+    collectors.add_argument("--machines", type=int, default=20000, help="Number of mock machines")
+    collectors.add_argument("--databases", type=int, default=2000, help="Number of mock databases")
+    collectors.add_argument("--latency", type=float, default=0.02, help="Mock controller latency per request, in seconds")
+    collectors.add_argument("--error-rate", type=float, default=0.0, help="Share of requests the mock controller fails with a 503")
+    collectors.add_argument("--workers", type=int, default=8, help="Workers passed to the script")
+    collectors.add_argument("--collectors", nargs="+", default=COLLECTORS, choices=COLLECTORS, help="Collectors to run")
+    collectors.set_defaults(func=bench_collectors)
+
+    exclude_rollout = subparsers.add_parser("exclude-rollout", help="Wall time and peak RSS of the call graph exclude rollout to all applications")
+    exclude_rollout.add_argument("--apps", type=int, default=2000, help="Number of mock applications")
+    exclude_rollout.add_argument("--latency", type=float, default=0.02, help="Mock controller latency per request, in seconds")
+    exclude_rollout.add_argument("--error-rate", type=float, default=0.0, help="Share of requests the mock controller fails with a 503")
+    exclude_rollout.add_argument("--workers", type=int, nargs="+", default=[4, 16, 32], help="Worker counts to measure")
+    exclude_rollout.set_defaults(func=bench_exclude_rollout)
+
+    throttling = subparsers.add_parser("throttling", help="Business transaction collection against a controller that throttles, fixed vs adaptive concurrency")
+    throttling.add_argument("--apps", type=int, default=500, help="Number of mock applications")
+    throttling.add_argument("--latency", type=float, default=0.05, help="Mock controller latency per request, in seconds")
+    throttling.add_argument("--max-in-flight", type=int, default=8, help="Requests the mock controller serves at once before answering 429")
+    throttling.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with each 429")
+    throttling.add_argument("--workers", type=int, default=32, help="Workers for both runs")
+    throttling.set_defaults(func=bench_throttling)
+
+    json_parser = subparsers.add_parser("json", help="Decode and encode time of fixture payloads by JSON backend, and collector output with projection")
+    json_parser.add_argument("--fixtures", help="JSON file mapping endpoint names to recorded responses, instead of synthetic payloads")
+    json_parser.add_argument("--bts", type=int, default=2000, help="Business transactions in the synthetic BT list payload")
+    json_parser.add_argument("--machines", type=int, default=500, help="Machines in the synthetic server metrics payload")
+    json_parser.add_argument("--repeat", type=int, default=5, help="Times to time each decode and encode, the best is reported")
+    json_parser.add_argument("--apps", type=int, default=200, help="Number of mock applications for the collector runs")
+    json_parser.add_argument("--latency", type=float, default=0.01, help="Mock controller latency per request, in seconds")
+    json_parser.add_argument("--workers", type=int, default=8, help="Workers passed to the script")
+    json_parser.set_defaults(func=bench_json)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
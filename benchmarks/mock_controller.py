@@ -0,0 +1,358 @@
+"""Local stand-in for an AppDynamics controller, used by the benchmarks.
+
+Serves synthetic responses for the endpoints the utility scripts call, with a
+fixed per-request latency so that request concurrency shows up in wall time.
+Responses recorded from a real controller can replace the synthetic ones, and
+a share of requests can be failed to exercise retries.
+
+usage: python benchmarks/mock_controller.py [--apps 5000] [--machines 20000] [--error-rate 0.01] [--port 8090]
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BT_COLUMNS = ["NAME", "BT_HEALTH", "AVERAGE_RESPONSE_TIME", "CALL_PER_MIN", "ERRORS_PER_MIN", "PERCENTAGE_ERROR",
+              "PERCENTAGE_SLOW_TRANSACTIONS", "PERCENTAGE_VERY_SLOW_TRANSACTIONS", "PERCENTAGE_STALLED_TRANSACTIONS",
+              "END_TO_END_LATENCY_TIME", "MAX_RESPONSE_TIME", "MIN_RESPONSE_TIME", "CALLS", "SLOW_TRANSACTIONS",
+              "CPU_USED", "TOTAL_ERRORS", "BLOCK_TIME", "WAIT_TIME", "VERY_SLOW_TRANSACTIONS", "STALLED_TRANSACTIONS"]
+
+TOKEN_PATH = "/controller/api/oauth/access_token"
+APPLICATION_CONFIGURATION_PATH = "/controller/restui/applicationManagerUiBean/applicationConfiguration/"
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+
+class MockController:
+    def __init__(self, apps=100, bts_per_app=20, security_items_per_app=3, latency=0.05, machines=100,
+                 latency_per_id=0.0, databases=50, etags=False, error_rate=0.0, error_status=503, fixtures=None, seed=0,
+                 max_in_flight=None, retry_after=1, port=0):
+        self.apps = apps
+        self.machines = machines
+        self.databases = databases
+        # answer GETs with an ETag, and If-None-Match with 304 when the body is unchanged
+        self.etags = etags
+        # extra latency per machine id in a health or metrics request, as large requests are slower
+        self.latency_per_id = latency_per_id
+        self.bts_per_app = bts_per_app
+        self.security_items_per_app = security_items_per_app
+        self.latency = latency
+        # the share of requests answered with error_status instead, 429s come with a Retry-After
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.errors = 0
+        # requests beyond max_in_flight at once are throttled with a 429, as a busy controller would
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.throttled = 0
+        self._random = random.Random(seed)
+        # recorded responses by path, served instead of the synthetic ones
+        self.fixtures = fixtures or {}
+        self.requests = 0
+        self.bytes_sent = 0
+        self.calls = Counter()
+        self.tokens = set()
+        self.saved_configs = {}
+        self.agent_configurations = {}
+        self._lock = threading.Lock()
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        controller = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                controller._handle(self, None)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length) if length else b""
+                controller._handle(self, json.loads(body) if body.startswith((b"{", b"[")) else body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = _Server(("127.0.0.1", self.port), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def revoke_tokens(self):
+        self.tokens.clear()
+
+    def _handle(self, handler, body):
+        url = urlparse(handler.path)
+        with self._lock:
+            self.requests += 1
+            self.calls[url.path] += 1
+            failed = self.error_rate and self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+            throttled = self.max_in_flight is not None and self.in_flight >= self.max_in_flight
+            if throttled:
+                self.throttled += 1
+            else:
+                self.in_flight += 1
+        if throttled:
+            self._send(handler, 429, {"error": "too many requests"})
+            return
+        try:
+            time.sleep(self.latency)
+            self._respond(handler, body, url, failed)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _respond(self, handler, body, url, failed):
+        if failed:
+            self._send(handler, self.error_status, {"error": "injected failure"})
+            return
+        route = ROUTES.get(url.path)
+        if url.path in self.fixtures:
+            route = lambda controller, body, query: controller.fixtures[url.path]
+        if route is None:
+            for prefix, suffix, app_route in APP_ROUTES:
+                if url.path.startswith(prefix) and url.path.endswith(suffix):
+                    app_id = int(url.path[len(prefix):len(url.path) - len(suffix)])
+                    route = lambda controller, body, query: app_route(controller, body, query, app_id)
+                    break
+        if route is None:
+            self._send(handler, 404, {"error": f"no mock route for {url.path}"})
+            return
+        if route is not MockController.access_token and handler.headers.get("Authorization", "")[len("Bearer "):] not in self.tokens:
+            self._send(handler, 401, {"error": "invalid or expired token"})
+            return
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        self._send(handler, 200, route(self, body, query))
+
+    def _send(self, handler, status, payload):
+        data = json.dumps(payload).encode()
+        etag = None
+        if self.etags and status == 200 and handler.command == "GET":
+            etag = f'"{hashlib.sha1(data).hexdigest()}"'
+            if handler.headers.get("If-None-Match") == etag:
+                status, data = 304, b""
+        with self._lock:
+            self.bytes_sent += len(data)
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        if status == 429 and self.retry_after is not None:
+            handler.send_header("Retry-After", str(self.retry_after))
+        if etag:
+            handler.send_header("ETag", etag)
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def access_token(self, body, query):
+        with self._lock:
+            token = f"mock-token-{self.calls[TOKEN_PATH]}"
+            self.tokens.add(token)
+        return {"access_token": token, "expires_in": 300}
+
+    def app_list_all(self, body, query):
+        return {"data": list(range(1, self.apps + 1))}
+
+    def app_list_ids(self, body, query):
+        return {"data": [{"id": app_id, "name": f"app-{app_id}", "appOverallHealth": "NORMAL", "calls": app_id * 10,
+                          "callsPerMinute": app_id, "averageResponseTime": app_id % 500, "errorPercent": app_id % 7,
+                          "errors": app_id % 13, "errorsPerMinute": app_id % 3, "nodeHealth": "NORMAL", "btHealth": "NORMAL"}
+                         for app_id in body["requestFilter"]]}
+
+    def bt_list(self, body, query):
+        app_id = body["requestFilter"]["queryParams"]["applicationIds"][0]
+        entries = []
+        for bt in range(self.bts_per_app):
+            entry = {"id": app_id * 1000 + bt, "name": f"/app/{app_id}/bt/{bt}", "internalName": f"/app/{app_id}/bt/{bt}",
+                     "entryPointType": "SERVLET", "tierId": app_id * 100 + bt % 4, "tierName": f"tier-{bt % 4}"}
+            for column in BT_COLUMNS[1:]:
+                entry[column.lower()] = bt
+            entries.append(entry)
+        return {
+            "applicationEntity": {"name": f"app-{app_id}", "entityDefinition": {"entityId": app_id}},
+            "btListEntries": entries,
+        }
+
+    def rest_applications(self, body, query):
+        return [{"name": f"app-{app_id}", "id": app_id} for app_id in range(1, self.apps + 1)]
+
+    def application_configuration(self, body, query, app_id):
+        config = {}
+        for section, agent_type in [("callGraphConfiguration", "APP_AGENT"), ("dotNetCallGraphConfiguration", "DOT_NET_APP_AGENT")]:
+            saved = self.saved_configs.get((app_id, agent_type))
+            config[section] = saved or {"excludedPackages": [f"name=com.vendor{n},description=vendor {n},system=false" for n in range(5)]}
+        return config
+
+    def save_call_graph(self, body, query):
+        with self._lock:
+            self.saved_configs[(body["applicationId"], body["agentType"])] = body["config"]
+        return {}
+
+    def tiers(self, app_id):
+        return [{"name": f"tier-{tier}", "id": app_id * 100 + tier, "agentType": "DOT_NET_APP_AGENT" if tier % 2 else "APP_AGENT"}
+                for tier in range(4)]
+
+    def rest_tiers(self, body, query, app_id):
+        return self.tiers(app_id)
+
+    def application_components(self, body, query, app_id):
+        return [{"name": f"app-{app_id}", "children": [dict(tier, customized=tier["id"] % 4 < 2) for tier in self.tiers(app_id)]}]
+
+    def get_agent_configuration(self, body, query):
+        key = body["key"]
+        entity = key["attachedEntity"]
+        saved = self.agent_configurations.get((key["agentType"], entity["entityType"], entity["entityId"]))
+        return saved or {"agentType": key["agentType"], "attachedEntity": dict(entity), "properties": []}
+
+    def update_agent_configuration(self, body, query):
+        entity = body["attachedEntity"]
+        with self._lock:
+            self.agent_configurations[(body["agentType"], entity["entityType"], entity["entityId"])] = body
+        return body
+
+    def machine_keys(self, body, query):
+        return {"machineKeys": [{"machineId": machine_id, "serverName": f"server-{machine_id}"}
+                                for machine_id in range(1, self.machines + 1)]}
+
+    def machine_health(self, body, query):
+        time.sleep(self.latency_per_id * len(body["machineIds"]))
+        return {"health": {str(machine_id): {"status": "NORMAL", "violations": 0} for machine_id in body["machineIds"]}}
+
+    def machine_metrics(self, body, query):
+        time.sleep(self.latency_per_id * len(body["ids"]))
+        data = {}
+        for rollup in body["rollups"]:
+            # a point per minute of the 15 minute window, or a single point for the 1440 rollup
+            points = 15 if rollup == 1 else 1
+            data[str(rollup)] = {
+                str(machine_id): {"metricData": {
+                    name: [{"startTimeInMillis": point * 60000, "value": (machine_id + point) % 100, "min": 0, "max": 100,
+                            "current": (machine_id + point) % 100, "count": rollup, "sum": (machine_id + point) % 100 * rollup,
+                            "occurrences": 1, "standardDeviation": 0, "useRange": rollup > 1} for point in range(points)]
+                    for name in body["metricNames"]}}
+                for machine_id in body["ids"]}
+        return {"data": data}
+
+    def database_list(self, body, query):
+        return {"data": [{"configId": db_id, "id": db_id, "name": f"db-{db_id}", "type": "MYSQL"}
+                         for db_id in range(1, self.databases + 1)]}
+
+    def database_data(self, body, query):
+        # a point per minute, up to the data points asked for, over the requested window
+        minutes = max(1, int((body["timeRangeEnd"] - body["timeRangeStart"]) / 60000))
+        points = min(minutes, int(query.get("maxDataPointsPerMetric", 1440)))
+        time.sleep(self.latency_per_id * len(body["requestFilter"]) * points / 100)
+        return {"data": [{"id": db_id, "configId": db_id, "name": f"db-{db_id}", "health": "NORMAL",
+                          **{column: [{"startTimeInMillis": body["timeRangeStart"] + point * 60000, "value": (db_id * point) % 97}
+                                      for point in range(points)]
+                             for column in ["queries", "timeSpent", "cpu"]}}
+                         for db_id in body["requestFilter"]]}
+
+    def secure_apps(self, body, query):
+        return self._page([{"appdApplicationId": app_id, "name": f"app-{app_id}",
+                            "applicationSecurityEnabled": app_id % 2 == 1,
+                            "applicationSecurityEnabledComputed": app_id % 2 == 1}
+                           for app_id in range(1, self.apps + 1)], query)
+
+    def security_items(self, body, query):
+        return self._page([{"id": item, "severity": "LOW"} for item in range(self.security_items_per_app)], query)
+
+    def business_risk(self, body, query):
+        return {"items": [{"risk": "LOW", "applicationId": query.get("applicationId")}]}
+
+    def _page(self, items, query):
+        offset = int(query.get("offset", 0))
+        limit = int(query.get("max", len(items)))
+        return {"items": items[offset:offset + limit], "total": len(items)}
+
+ROUTES = {
+    TOKEN_PATH: MockController.access_token,
+    "/controller/restui/v1/app/list/all": MockController.app_list_all,
+    "/controller/restui/v1/app/list/ids": MockController.app_list_ids,
+    "/controller/restui/v1/bt/listViewDataByColumnsV2": MockController.bt_list,
+    "/controller/rest/applications": MockController.rest_applications,
+    "/controller/restui/configuration/callGraph/save": MockController.save_call_graph,
+    "/controller/argento/public-api/v1/applications": MockController.secure_apps,
+    "/controller/argento/public-api/v1/attacks": MockController.security_items,
+    "/controller/argento/public-api/v1/stats/businessRisk": MockController.business_risk,
+    "/controller/argento/public-api/v1/vulnerabilities": MockController.security_items,
+    "/controller/databasesui/databases/list": MockController.database_list,
+    "/controller/databasesui/databases/list/data": MockController.database_data,
+    "/controller/sim/v2/user/machines/keys": MockController.machine_keys,
+    "/controller/sim/v2/user/health": MockController.machine_health,
+    "/controller/sim/v2/user/metrics/query/machines": MockController.machine_metrics,
+    "/controller/restui/agentManager/getAgentConfiguration": MockController.get_agent_configuration,
+    "/controller/restui/agentManager/updateAgentConfigurationAndToggleAgentEnableStatusIfNeeded": MockController.update_agent_configuration,
+}
+
+# (prefix, suffix, handler) for paths with an application id between the two
+APP_ROUTES = [
+    (APPLICATION_CONFIGURATION_PATH, "", MockController.application_configuration),
+    ("/controller/rest/applications/", "/tiers", MockController.rest_tiers),
+    ("/controller/restui/agentManager/getAllApplicationComponentsWithNodes/", "", MockController.application_components),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the mock controller until interrupted")
+    parser.add_argument("--port", type=int, default=8090, help="Port to listen on, on 127.0.0.1")
+    parser.add_argument("--apps", type=int, default=100, help="Number of applications")
+    parser.add_argument("--bts", type=int, default=20, help="Business transactions per application")
+    parser.add_argument("--machines", type=int, default=100, help="Number of machines")
+    parser.add_argument("--databases", type=int, default=50, help="Number of databases")
+    parser.add_argument("--latency", type=float, default=0.05, help="Latency per request, in seconds")
+    parser.add_argument("--latency-per-id", type=float, default=0.0, help="Extra latency per id in a batched request, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests to fail")
+    parser.add_argument("--error-status", type=int, default=503, help="Status of the failed requests")
+    parser.add_argument("--max-in-flight", type=int, help="Requests to serve at once, more are throttled with a 429")
+    parser.add_argument("--etags", action="store_true", help="Answer GETs with ETags and conditional GETs with 304")
+    parser.add_argument("--fixtures", help="JSON file mapping paths to recorded responses to serve instead of synthetic ones")
+    args = parser.parse_args()
+
+    fixtures = None
+    if args.fixtures:
+        with open(args.fixtures) as f:
+            fixtures = json.load(f)
+    controller = MockController(apps=args.apps, bts_per_app=args.bts, latency=args.latency, machines=args.machines,
+                                latency_per_id=args.latency_per_id, databases=args.databases, etags=args.etags,
+                                error_rate=args.error_rate, error_status=args.error_status, fixtures=fixtures,
+                                max_in_flight=args.max_in_flight, port=args.port)
+    controller.start()
+    print(f"Mock controller at {controller.url}/, set APPD_CONTROLLER_URL to it with any client id and secret")
+    try:
+        controller._thread.join()
+    except KeyboardInterrupt:
+        controller.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,71 @@
 import argparse
 import logging
+import signal
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler
+from urllib.parse import urlparse
 
 import requests
-import json
 import os
+import sys
 import time
 
-_debug = False
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+import appd_json
+from appd_client import add_client_arguments, client_from_args, fan_out, shared_from_args
+from appd_json import JSON_BACKENDS
+from appd_state import DEFAULT_FULL_SNAPSHOT_INTERVAL, DEFAULT_STATE_DB, ChangeTracker, PollFailures
+
+ARGENTO_PAGE_SIZE = 1000
+DEFAULT_WINDOW_MINUTES = 15
+# machine ids per health and metrics request; one request for every machine gets slow on large controllers
+SERVER_CHUNK_SIZE = 500
+# database ids per metrics request, and the data points the controller returns for each metric
+DATABASE_CHUNK_SIZE = 200
+DATABASE_DATA_POINTS = 1440
+
+# the machine metrics collected for each server, and the column each becomes in flat server records
+SERVER_METRIC_COLUMNS = {
+    "Hardware Resources|Machine|Availability": "availability",
+    "Hardware Resources|Volumes|Used (%)": "volumes_used_pct",
+    "Hardware Resources|CPU|%Busy": "cpu_busy_pct",
+    "Hardware Resources|CPU|%Stolen": "cpu_stolen_pct",
+    "Hardware Resources|Memory|Used %": "memory_used_pct",
+    "Hardware Resources|Memory|Swap Used %": "swap_used_pct",
+    "Hardware Resources|Disks|Avg IO Utilization (%)": "disk_io_utilization_pct",
+    "Hardware Resources|Network|Avg Utilization (%)": "network_utilization_pct",
+    "Hardware Resources|Load|Last 1 minute": "load_1m",
+}
+
+BT_COLUMNS = ["NAME", "BT_HEALTH", "AVERAGE_RESPONSE_TIME", "CALL_PER_MIN", "ERRORS_PER_MIN", "PERCENTAGE_ERROR",
+              "PERCENTAGE_SLOW_TRANSACTIONS", "PERCENTAGE_VERY_SLOW_TRANSACTIONS", "PERCENTAGE_STALLED_TRANSACTIONS",
+              "END_TO_END_LATENCY_TIME", "MAX_RESPONSE_TIME", "MIN_RESPONSE_TIME", "CALLS", "SLOW_TRANSACTIONS", "CPU_USED",
+              "TOTAL_ERRORS", "BLOCK_TIME", "WAIT_TIME", "VERY_SLOW_TRANSACTIONS", "STALLED_TRANSACTIONS"]
+# with projection, BT entries keep only the result columns and these fields, and metric data points only
+# METRIC_POINT_FIELDS; the rest is dropped as soon as a response is decoded
+BT_IDENTITY_FIELDS = ["id", "internalName", "entryPointType", "tierId", "tierName"]
+METRIC_POINT_FIELDS = ["startTimeInMillis", "value", "min", "max"]
+COLLECTORS = ["applications", "databases", "servers", "business_transactions", "security"]
+# seconds to connect to or send a record to the --socket input before dropping the record
+SOCKET_TIMEOUT = 10
+
+# the field identifying each entity in iter_events records, for --changed-only
+ENTITY_KEYS = {
+    "applications": "id",
+    "databases": "id",
+    "servers": "machineId",
+    "business_transactions": "id",
+    "security": "appdApplicationId",
+    "attacks": "id",
+    "vulnerabilities": "id",
+}
 
 def load_config(config_file):
     if not os.path.exists(config_file):
@@ -17,214 +75,216 @@ def load_config(config_file):
         config = f.read()
     return config
 
-def get_bearer_token(appd_controller_url, appd_client_id, appd_client_secret):
-    appd_account = appd_controller_url.split("/")[2].split(".")[0]
-    response = requests.post(
-        f"{appd_controller_url}/controller/api/oauth/access_token",
-        headers={"Content-Type": "application/x-www-form-urlencoded"},
-        auth=(appd_client_id, appd_client_secret),
-        data={
-            "grant_type": "client_credentials",
-            "client_id": f"{appd_client_id}@{appd_account}",
-            "client_secret": appd_client_secret
-        }
-    )
-    if _debug:
-        print("Request URL:", response.request.url)
-        print("Request Payload:", response.request.body)
-        print("Response:", response.status_code, response.text)
-
-    response.raise_for_status()
-    return response.json()["access_token"]
-
-def getAppList(appd_controller_url, bearer):
-    request_headers = {
-        "Authorization": f"Bearer {bearer}",
-        "Content-Type": "application/json;charset=UTF-8",
-        "Accept": "application/json, text/plain, */*"
+def read_config(config_file):
+    """The controller URL, client id and client secret a config file like appdynamics-configuration.sh sets."""
+    settings = {}
+    exec(load_config(config_file), settings)
+    return settings.get("APPD_CONTROLLER_URL"), settings.get("APPD_CLIENT_ID"), settings.get("APPD_CLIENT_SECRET")
+
+def load_controllers(file_path):
+    """Controllers to poll from a JSON or YAML file, each with a url, client_id and client_secret or a config file setting them.
+
+    An entry can also set its own name, used as the controller field of its records, and its own
+    workers and rate_limit.
+    """
+    if not os.path.exists(file_path):
+        print(f"Controllers file {file_path} does not exist")
+        exit(1)
+    with open(file_path) as f:
+        if file_path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                print("Reading a YAML controllers file needs PyYAML, install it with 'pip install pyyaml' or use a JSON file")
+                exit(1)
+            document = yaml.safe_load(f)
+        else:
+            document = appd_json.loads(f.read())
+
+    controllers = []
+    for entry in document.get("controllers", []):
+        if "config" in entry:
+            url, client_id, client_secret = read_config(entry["config"])
+        else:
+            url, client_id, client_secret = entry.get("url"), entry.get("client_id"), entry.get("client_secret")
+        # entries carry secrets, so they are reported by name only
+        label = entry.get("name") or entry.get("config") or url
+        if not all([url, client_id, client_secret]):
+            print(f"Controller {label} needs a url, client_id and client_secret, or a config file setting them")
+            exit(1)
+        name = entry.get("name") or urlparse(url).hostname
+        if name in [controller["name"] for controller in controllers]:
+            print(f"Controllers file lists {name} more than once, give them different names")
+            exit(1)
+        controllers.append({"name": name, "url": url, "client_id": client_id, "client_secret": client_secret,
+                            "workers": entry.get("workers"), "rate_limit": entry.get("rate_limit")})
+    if not controllers:
+        print(f"Controllers file {file_path} doesn't list any controllers")
+        exit(1)
+    return controllers
+
+class TimeWindow:
+    """The time range of one poll, in the epoch milliseconds the controller expects.
+
+    Computed once per poll and passed to every collector, so all of them query the same window. The
+    end is aligned to the minute, so polls within a minute ask the controller the same question.
+    """
+
+    def __init__(self, minutes=DEFAULT_WINDOW_MINUTES, now=None):
+        now = time.time() if now is None else now
+        self.minutes = minutes
+        self.end = int(now // 60) * 60000
+        self.start = self.end - minutes * 60000
+        self.time_range = f"Custom_Time_Range.BETWEEN_TIMES.{self.end}.{self.start}.{minutes}"
+        self.started_at = self._iso(self.start)
+        self.ended_at = self._iso(self.end)
+        self._deep_links = {}
+
+    @staticmethod
+    def _iso(milliseconds):
+        return datetime.fromtimestamp(milliseconds / 1000, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+    def deep_link(self, client, location):
+        """The controller UI link to location over this window, for the caller to append its query to."""
+        key = (client.controller_url, location)
+        if key not in self._deep_links:
+            self._deep_links[key] = f"{client.controller_url}/controller/#/location={location}&timeRange={self.time_range}"
+        return self._deep_links[key]
+
+def list_request_body(window, request_filter, result_columns, column_sorts=None, search_filters=None):
+    """The body shared by the controller's restui list endpoints, querying window."""
+    return {
+        "requestFilter": request_filter,
+        "searchFilters": search_filters,
+        "timeRangeStart": window.start,
+        "timeRangeEnd": window.end,
+        "columnSorts": column_sorts,
+        "resultColumns": result_columns,
+        "offset": 0,
+        "limit": -1
     }
-    now = time.time()
-    request_body = {
-        "requestFilter": {
+
+def getAppList(client, window=None):
+    # shared by the application and BT collectors, so it comes from the inventory cache
+    return client.cached_inventory("app/list/all", lambda: fetchAppList(client, window))
+
+def fetchAppList(client, window=None):
+    request_body = list_request_body(
+        window or TimeWindow(),
+        {
             "filters":[{"field":"TYPE","criteria":"APM","operator":"EQUAL_TO"}],
             "filterAll" : False,
             "queryParams": {"applicationIds":[],"tags":[]}
         },
-        "searchFilters":[],
-        "timeRangeStart": now - (15 * 60000),
-        "timeRangeEnd": now,
-        "columnSorts": [{"column":"APP_OVERALL_HEALTH","direction":"DESC"}],
-        "resultColumns":["NAME"],
-        "offset":0,
-        "limit":-1
-    }
+        ["NAME"],
+        column_sorts=[{"column":"APP_OVERALL_HEALTH","direction":"DESC"}],
+        search_filters=[]
+    )
 
-    response = requests.post(
-        f"{appd_controller_url}/controller/restui/v1/app/list/all",
-        headers=request_headers,
+    response = client.post(
+        "/controller/restui/v1/app/list/all",
         json=request_body
     )
-
-    if _debug:
-        print("Request URL:", response.request.url)
-        print("Request Headers:", response.request.headers)
-        print("Request Payload:", response.request.body)
-        print("Response:", response.status_code, response.text)
-
-    if response.status_code >= 300:
-        print(f"Error: {response.status_code} - {response.text}")
-        # Print the request body for debugging
-        print("Request header:", json.dumps(request_headers, indent=2))
-        print("Request body:", json.dumps(request_body, indent=2))
-
-    response.raise_for_status()
     return response.json()['data']
 
-def getApplicationSummary(appd_controller_url, bearer):
-    request_headers = {
-        "Authorization": f"Bearer {bearer}",
-        "Content-Type": "application/json;charset=UTF-8",
-        "Accept": "application/json, text/plain, */*"
-    }
-    now = round(time.time()*1000)
-    timeRangeStart = now - (15 * 60000)
-    timeRangeEnd = now
-    request_body = {
-        "requestFilter": getAppList(appd_controller_url, bearer),
-        "timeRangeStart": timeRangeStart,
-        "timeRangeEnd": timeRangeEnd,
-        "searchFilters": None,
-        "columnSorts": None,
-        "resultColumns": ["APP_OVERALL_HEALTH","CALLS","CALLS_PER_MINUTE","AVERAGE_RESPONSE_TIME","ERROR_PERCENT","ERRORS","ERRORS_PER_MINUTE","NODE_HEALTH","BT_HEALTH"],
-        "offset":0,
-        "limit":-1
-    }
+def getApplicationSummary(client, window=None):
+    window = window or TimeWindow()
+    request_body = list_request_body(
+        window,
+        getAppList(client, window),
+        ["APP_OVERALL_HEALTH","CALLS","CALLS_PER_MINUTE","AVERAGE_RESPONSE_TIME","ERROR_PERCENT","ERRORS","ERRORS_PER_MINUTE","NODE_HEALTH","BT_HEALTH"]
+    )
 
-    response = requests.post(
-        f"{appd_controller_url}/controller/restui/v1/app/list/ids",
-        headers=request_headers,
+    response = client.post(
+        "/controller/restui/v1/app/list/ids",
         json=request_body
     )
 
-    if _debug:
-        print("Request URL:", response.request.url)
-        print("Request Headers:", response.request.headers)
-        print("Request Payload:", response.request.body)
-        print("Response:", response.status_code, response.text)
-
-    if response.status_code >= 300:
-        print(f"Error: {response.status_code} - {response.text}")
-        # Print the request body for debugging
-        print("Request header:", json.dumps(request_headers, indent=2))
-        print("Request body:", json.dumps(request_body, indent=2))
-
-    response.raise_for_status()
-
     data = response.json()
-    minutes = round( (timeRangeEnd/60000) - (timeRangeStart/60000))
+    deepLinkPrefix = window.deep_link(client, "APP_DASHBOARD")
     for item in data['data']:
-        item['deepLink'] = f"{appd_controller_url}/controller/#/location=APP_DASHBOARD&timeRange=Custom_Time_Range.BETWEEN_TIMES.{timeRangeEnd}.{timeRangeStart}.{minutes}&application={item['id']}&dashboardMode=force"
+        item['deepLink'] = f"{deepLinkPrefix}&application={item['id']}&dashboardMode=force"
     return data
 
-def getDatabaseSummary(appd_controller_url, bearer):
-    request_headers = {
-        "Authorization": f"Bearer {bearer}",
-        "Content-Type": "application/json;charset=UTF-8",
-        "Accept": "application/json, text/plain, */*"
-    }
-    now = round(time.time()*1000)
-    timeRangeStart = now - (15 * 60000)
-    timeRangeEnd = now
-    request_body = {
-        "requestFilter": {},
-        "resultColumns": ["ID", "NAME", "TYPE"],
-        "offset": 0,
-        "limit": -1,
-        "searchFilters": [],
-        "columnSorts": [{"column": "HEALTH", "direction": "ASC"}],
-        "timeRangeStart": timeRangeStart,
-        "timeRangeEnd": timeRangeEnd
-    }
+def getDatabaseSummary(client, workers=1, chunk_size=DATABASE_CHUNK_SIZE, data_points=DATABASE_DATA_POINTS, summarize=False,
+                       window=None):
+    return {"data": list(iterDatabaseSummary(client, workers, chunk_size, data_points, summarize, window))}
 
+def iterDatabaseSummary(client, workers=1, chunk_size=DATABASE_CHUNK_SIZE, data_points=DATABASE_DATA_POINTS, summarize=False,
+                        window=None, failures=None):
+    """Yield databases with their metrics, fetched for chunk_size databases per request on up to workers threads.
 
-    response = requests.post(
-        f"{appd_controller_url}/controller/databasesui/databases/list?maxDataPointsPerMetric=1440",
-        headers=request_headers,
+    With summarize, each metric's time series is replaced by its last, average and maximum values as soon
+    as its chunk arrives, so only the summaries are kept. Chunks that fail are logged, skipped and added
+    to failures, a PollFailures, when given.
+    """
+    window = window or TimeWindow()
+    request_body = list_request_body(window, {}, ["ID", "NAME", "TYPE"],
+                                     column_sorts=[{"column": "HEALTH", "direction": "ASC"}], search_filters=[])
+
+    response = client.post(
+        f"/controller/databasesui/databases/list?maxDataPointsPerMetric={data_points}",
         json=request_body
     )
 
-    if _debug:
-        print("Request URL:", response.request.url)
-        print("Request Headers:", response.request.headers)
-        print("Request Payload:", response.request.body)
-        print("Response:", response.status_code, response.text)
-
-
-    if response.status_code >= 300:
-        print(f"Error: {response.status_code} - {response.text}")
-        # Print the request body for debugging
-        print("Request header:", json.dumps(request_headers, indent=2))
-        print("Request body:", json.dumps(request_body, indent=2))
-
-    response.raise_for_status()
-
     health_data = response.json()
     database_ids = [item['configId'] for item in health_data['data']]
-    metrics_data = fetch_database_data(appd_controller_url, bearer, database_ids)
-    for item in metrics_data['data']:
-        minutes = round( (timeRangeEnd/60000) - (timeRangeStart/60000))
-        item['deepLink'] = f"{appd_controller_url}/controller/#/location=DB_MONITORING_SERVER_DASHBOARD&timeRange=Custom_Time_Range.BETWEEN_TIMES.{timeRangeEnd}.{timeRangeStart}.{minutes}&dbServerId={item['id']}"
-    return metrics_data
+    chunks = [database_ids[start:start + chunk_size] for start in range(0, len(database_ids), max(1, chunk_size))]
+    deepLinkPrefix = window.deep_link(client, "DB_MONITORING_SERVER_DASHBOARD")
+
+    missing = 0
+    for chunk, future in fan_out(lambda chunk: fetch_database_data(client, chunk, data_points, window), chunks, workers):
+        try:
+            metrics_data = future.result()
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            logging.error(f"Failed to collect metrics for {len(chunk)} databases: {e}")
+            missing += len(chunk)
+            if failures is not None:
+                failures.add(f"databases {chunk}")
+            continue
+        for item in metrics_data['data']:
+            if summarize:
+                item = summarize_time_series(item)
+            item['deepLink'] = f"{deepLinkPrefix}&dbServerId={item['id']}"
+            yield item
+
+    if missing:
+        logging.warning(f"Databases missing for {missing} of {len(database_ids)} databases")
+
+def is_time_series(value):
+    return isinstance(value, list) and len(value) > 0 and all(
+        isinstance(point, (int, float)) or (isinstance(point, dict) and "value" in point) for point in value)
+
+def summarize_time_series(value):
+    """Replace every time series in value, at any depth, with {"last", "avg", "max"} of its values."""
+    if is_time_series(value):
+        values = [point["value"] if isinstance(point, dict) else point for point in value]
+        values = [v for v in values if isinstance(v, (int, float))]
+        if not values:
+            return {"last": None, "avg": None, "max": None}
+        return {"last": values[-1], "avg": sum(values) / len(values), "max": max(values)}
+    if isinstance(value, dict):
+        return {name: summarize_time_series(item) for name, item in value.items()}
+    if isinstance(value, list):
+        return [summarize_time_series(item) for item in value]
+    return value
 
 # Function to fetch database data
-def fetch_database_data(controller_url, token, database_ids):
-    url = f"{controller_url}/controller/databasesui/databases/list/data?maxDataPointsPerMetric=1440"
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json;charset=UTF-8',
-        'Accept': 'application/json, text/plain, */*'
-    }
-    now = time.time()
-    body = {
-        "requestFilter": database_ids,
-        "resultColumns": ["HEALTH", "QUERIES", "TIME_SPENT", "CPU"],
-        "offset": 0,
-        "limit": -1,
-        "searchFilters": [],
-        "columnSorts": [{"column": "TIME_SPENT", "direction": "DESC"}],
-        "timeRangeStart": (int(now) - (15 * 60000))*1000,
-        "timeRangeEnd": int(now)*1000
-    }
-    response = requests.post(url, headers=headers, json=body)
-
-    if _debug:
-        print("Request URL:", response.request.url)
-        print("Request Headers:", response.request.headers)
-        print("Request Payload:", response.request.body)
-        print("Response:", response.status_code, response.text)
-
-    if response.status_code >= 300:
-        print(f"Error: {response.status_code} - {response.text}")
-        print("Request header:", json.dumps(headers, indent=2))
-        print("Request body:", json.dumps(body, indent=2))
-    response.raise_for_status()
+def fetch_database_data(client, database_ids, data_points=DATABASE_DATA_POINTS, window=None):
+    path = f"/controller/databasesui/databases/list/data?maxDataPointsPerMetric={data_points}"
+    body = list_request_body(window or TimeWindow(), database_ids, ["HEALTH", "QUERIES", "TIME_SPENT", "CPU"],
+                             column_sorts=[{"column": "TIME_SPENT", "direction": "DESC"}], search_filters=[])
+    response = client.post(path, json=body)
     return response.json()
 
-def getServerList(appd_controller_url, bearer):
-    request_headers = {
-        "Authorization": f"Bearer {bearer}",
-        "Content-Type": "application/json",
-        "Accept": "application/json, text/plain, */*"
-    }
-    now = time.time()
+def getServerList(client, window=None):
+    window = window or TimeWindow()
     request_body = {
         "filter": {
             "appIds": [],
             "nodeIds": [],
             "tierIds": [],
             "types": ["PHYSICAL", "CONTAINER_AWARE"],
-            "timeRangeStart": int(now) - (15 * 60000),
-            "timeRangeEnd": int(now)
+            "timeRangeStart": window.start,
+            "timeRangeEnd": window.end
         },
         "sorter": {
             "field": "HEALTH",
@@ -232,172 +292,204 @@ def getServerList(appd_controller_url, bearer):
         }
     }
 
-    response = requests.post(
-        f"{appd_controller_url}/controller/sim/v2/user/machines/keys",
-        headers=request_headers,
+    response = client.post(
+        "/controller/sim/v2/user/machines/keys",
+        headers={"Content-Type": "application/json"},
         json=request_body
     )
-
-    if _debug:
-        print("Request URL:", response.request.url)
-        print("Request Headers:", response.request.headers)
-        print("Request Payload:", response.request.body)
-        print("Response:", response.status_code, response.text)
-
-    if response.status_code >= 300:
-        print(f"Error: {response.status_code} - {response.text}")
-        # Print the request body for debugging
-        print("Request header:", json.dumps(request_headers, indent=2))
-        print("Request body:", json.dumps(request_body, indent=2))
-
-    response.raise_for_status()
     return response.json()
 
-def getServerHealth(appd_controller_url, bearer, machine_ids):
-    request_headers = {
-        "Authorization": f"Bearer {bearer}",
-        "Content-Type": "application/json",
-        "Accept": "application/json, text/plain, */*"
-    }
+def getServerHealth(client, machine_ids, window=None):
+    window = window or TimeWindow()
     request_body = {
-        "timeRangeSpecifier": "last_1_hour.BEFORE_NOW.-1.-1.60",
+        "timeRangeSpecifier": window.time_range,
         "machineIds": machine_ids
     }
 
-    response = requests.post(
-        f"{appd_controller_url}/controller/sim/v2/user/health",
-        headers=request_headers,
+    response = client.post(
+        "/controller/sim/v2/user/health",
+        headers={"Content-Type": "application/json"},
         json=request_body
     )
-
-    if _debug:
-        print("Request URL:", response.request.url)
-        print("Request Headers:", response.request.headers)
-        print("Request Payload:", response.request.body)
-        print("Response:", response.status_code, response.text)
-
-    if response.status_code >= 300:
-        print(f"Error: {response.status_code} - {response.text}")
-        # Print the request body for debugging
-        print("Request header:", json.dumps(request_headers, indent=2))
-        print("Request body:", json.dumps(request_body, indent=2))
-
-    response.raise_for_status()
     return response.json()
 
-def getServerMetrics(appd_controller_url, bearer, machine_ids):
-    request_headers = {
-        "Authorization": f"Bearer {bearer}",
-        "Content-Type": "application/json",
-        "Accept": "application/json, text/plain, */*"
-    }
-    now = round(time.time()*1000)
-    timeRangeStart = now - (15 * 60000)
-    timeRangeEnd = now
-    minutes = round( (timeRangeEnd/60000) - (timeRangeStart/60000))
+def getServerMetrics(client, machine_ids, window=None):
+    window = window or TimeWindow()
     request_body = {
-        "timeRange": f"Custom_Time_Range.BETWEEN_TIMES.{timeRangeEnd}.{timeRangeStart}.{minutes}",
+        "timeRange": window.time_range,
         "ids": machine_ids,
-        "metricNames": [
-            "Hardware Resources|Machine|Availability",
-            "Hardware Resources|Volumes|Used (%)",
-            "Hardware Resources|CPU|%Busy",
-            "Hardware Resources|CPU|%Stolen",
-            "Hardware Resources|Memory|Used %",
-            "Hardware Resources|Memory|Swap Used %",
-            "Hardware Resources|Disks|Avg IO Utilization (%)",
-            "Hardware Resources|Network|Avg Utilization (%)",
-            "Hardware Resources|Load|Last 1 minute"
-        ],
+        "metricNames": list(SERVER_METRIC_COLUMNS),
         "baselineId": None,
         "rollups": [1, 1440]
     }
 
-    response = requests.post(
-        f"{appd_controller_url}/controller/sim/v2/user/metrics/query/machines",
-        headers=request_headers,
+    response = client.post(
+        "/controller/sim/v2/user/metrics/query/machines",
+        headers={"Content-Type": "application/json"},
         json=request_body
     )
-
-    if _debug:
-        print("Request URL:", response.request.url)
-        print("Request Headers:", response.request.headers)
-        print("Request Payload:", response.request.body)
-        print("Response:", response.status_code, response.text)
-
-    if response.status_code >= 300:
-        print(f"Error: {response.status_code} - {response.text}")
-        # Print the request body for debugging
-        print("Request header:", json.dumps(request_headers, indent=2))
-        print("Request body:", json.dumps(request_body, indent=2))
-
-    response.raise_for_status()
     return response.json()
 
-def getServerSummary(appd_controller_url, bearer):
+def field_key(name):
+    # result columns are upper snake case, the fields they come back as camel case
+    return name.replace("_", "").lower()
+
+BT_FIELD_KEYS = {field_key(name) for name in BT_COLUMNS + BT_IDENTITY_FIELDS}
+
+def project_bt_entry(entry):
+    return {name: value for name, value in entry.items() if field_key(name) in BT_FIELD_KEYS}
+
+def project_metric_data(metric_data):
+    """metricData with only METRIC_POINT_FIELDS in each data point, a metric being a list of points or one point."""
+    def project_point(point):
+        return {field: point[field] for field in METRIC_POINT_FIELDS if field in point}
+    return {name: [project_point(point) for point in series] if isinstance(series, list) else
+                  project_point(series) if isinstance(series, dict) else series
+            for name, series in metric_data.items()}
+
+def metric_points(series):
+    # a metric comes back as a list of data points, or as a single point
+    if not series:
+        return []
+    return series if isinstance(series, list) else [series]
+
+class ServerRecord:
+    """One machine with the latest value and the 1440 rollup of each metric, instead of the raw metric series."""
+    __slots__ = ("machine_id", "server_name", "deep_link", "health", "latest", "rollup")
+
+    def __init__(self, machine_id, server_name, deep_link, health, latest_metrics, rollup_metrics):
+        self.machine_id = machine_id
+        self.server_name = server_name
+        self.deep_link = deep_link
+        self.health = health
+        self.latest = tuple(self._latest(latest_metrics.get(name)) for name in SERVER_METRIC_COLUMNS)
+        self.rollup = tuple(self._rollup(rollup_metrics.get(name)) for name in SERVER_METRIC_COLUMNS)
+
+    @staticmethod
+    def _latest(series):
+        points = metric_points(series)
+        return points[-1].get("value") if points else None
+
+    @staticmethod
+    def _rollup(series):
+        points = metric_points(series)
+        if not points:
+            return None
+        return points[-1].get("value"), points[-1].get("min"), points[-1].get("max")
+
+    def flatten(self):
+        """The record as fixed columns: each metric's latest value, then its 1440 rollup average, min and max."""
+        record = {"machineId": self.machine_id, "serverName": self.server_name, "deepLink": self.deep_link,
+                  "health": self.health}
+        for column, latest, rollup in zip(SERVER_METRIC_COLUMNS.values(), self.latest, self.rollup):
+            record[column] = latest
+            record[f"{column}_avg"], record[f"{column}_min"], record[f"{column}_max"] = rollup or (None, None, None)
+        return record
+
+def getServerSummary(client, workers=1, chunk_size=SERVER_CHUNK_SIZE, compact=False, window=None, project=False):
+    """Servers by machine id; with compact they are ServerRecords, flatten them for output."""
+    return dict(iterServerSummary(client, workers, chunk_size, compact=compact, window=window, project=project))
+
+def iterServerSummary(client, workers=1, chunk_size=SERVER_CHUNK_SIZE, order="controller", compact=False, window=None,
+                      project=False, failures=None):
+    """Yield (machine_id, server) pairs, a chunk of machines at a time as their health and metrics arrive.
+
+    With compact, each server is a ServerRecord and the raw metric series are dropped as soon as a chunk
+    is merged, otherwise it is a dict carrying the controller's 1440 rollup metricData, as is or projected.
+    Chunks that fail are logged, skipped and added to failures, a PollFailures, when given.
+    """
+    window = window or TimeWindow()
     # Fetch the list of servers
-    server_list = getServerList(appd_controller_url, bearer)
-    machine_ids = [server["machineId"] for server in server_list.get("machineKeys", [])]
-
-    # Fetch health and metrics data for the machines
-    health_data = getServerHealth(appd_controller_url, bearer, machine_ids)
-    metrics_data = getServerMetrics(appd_controller_url, bearer, machine_ids)
-
-    now = round(time.time()*1000)
-    timeRangeStart = now - (15 * 60000)
-    timeRangeEnd = now
-    minutes = round( (timeRangeEnd/60000) - (timeRangeStart/60000))
-    # Combine data into a single dictionary
-    combined_data = {}
-    for server in server_list.get("machineKeys", []):
-        machine_id = server["machineId"]
-        combined_data[machine_id] = {
-            "serverName": server["serverName"],
-            "deepLink": f"{appd_controller_url}/controller/#/location=SERVER_MONITORING_MACHINE_OVERVIEW&timeRange=Custom_Time_Range.BETWEEN_TIMES.{timeRangeEnd}.{timeRangeStart}.{minutes}&machineId={machine_id}",
-            "health": None,
-            "metrics": {}
-        }
-
-    # Merge health data
-    for machine_id, health in health_data.get("health", {}).items():
-        if int(machine_id) in combined_data:
-            combined_data[int(machine_id)]["health"] = health
-
-    # Merge metrics data
-    metrics_data_points = metrics_data.get("data", {}).get("1440", {})
-    for machine_id, metrics in metrics_data_points.items():
-        if int(machine_id) in combined_data:
-            combined_data[int(machine_id)]["metrics"] = metrics.get("metricData", {})
-
-    return combined_data
-
-
-def getBusinessTransactionsSummary(appd_controller_url, bearer):
-    applications = getAppList(appd_controller_url, bearer)
-    now = round(time.time()*1000)
-    timeRangeStart = now - (15 * 60000)
-    timeRangeEnd = now
-    minutes = round( (timeRangeEnd/60000) - (timeRangeStart/60000))
-    btData = []
-    for application in applications:
-        appBTData = getApplicationBusinessTransactions(appd_controller_url, bearer, application)
-        appBTData['deepLink'] = f"{appd_controller_url}/controller/#/location=APP_BT_LIST&timeRange=Custom_Time_Range.BETWEEN_TIMES.{timeRangeEnd}.{timeRangeStart}.{minutes}&application={appBTData['applicationEntity']['entityDefinition']['entityId']}"
-        btData.append( {"application": appBTData})
-    return btData
-
-def getApplicationBusinessTransactions(appd_controller_url, bearer, application):
-    url = f"{appd_controller_url}/controller/restui/v1/bt/listViewDataByColumnsV2"
-    headers = {
-        'Authorization': f'Bearer {bearer}',
-        'Content-Type': 'application/json;charset=UTF-8',
-        'Accept': 'application/json, text/plain, */*'
-    }
-    now = round(time.time()*1000)
-    timeRangeStart = now - (15 * 60000)
-    timeRangeEnd = now
-    minutes = round( (timeRangeEnd/60000) - (timeRangeStart/60000))
-    body = {
-        "requestFilter": {
+    server_list = getServerList(client, window)
+    servers = server_list.get("machineKeys", [])
+    chunks = [servers[start:start + chunk_size] for start in range(0, len(servers), max(1, chunk_size))]
+
+    deepLinkPrefix = window.deep_link(client, "SERVER_MONITORING_MACHINE_OVERVIEW") + "&machineId="
+
+    # health and metrics for every chunk are separate requests, so both endpoints are queried concurrently
+    calls = {"health": getServerHealth, "metrics": getServerMetrics}
+    tasks = [(index, field) for index in range(len(chunks)) for field in calls]
+    def fetchChunk(task):
+        index, field = task
+        return calls[field](client, [server["machineId"] for server in chunks[index]], window)
+
+    received = {}
+    missing = 0
+    for (index, field), future in fan_out(fetchChunk, tasks, workers, ordered=order != "completion"):
+        try:
+            received.setdefault(index, {})[field] = future.result()
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            logging.error(f"Failed to collect server {field} for {len(chunks[index])} machines: {e}")
+            received.setdefault(index, {})[field] = None
+        if len(received[index]) < len(calls):
+            continue
+
+        chunk_data = received.pop(index)
+        if chunk_data["health"] is None or chunk_data["metrics"] is None:
+            missing += len(chunks[index])
+            if failures is not None:
+                failures.add(f"machines {[server['machineId'] for server in chunks[index]]}")
+            continue
+        health_data = chunk_data["health"].get("health", {})
+        metrics_data_points = chunk_data["metrics"].get("data", {}).get("1440", {})
+        latest_data_points = chunk_data["metrics"].get("data", {}).get("1", {})
+        # the controller keys both responses by machine id as a string
+        for server in chunks[index]:
+            machine_id = server["machineId"]
+            metrics = metrics_data_points.get(str(machine_id))
+            if compact:
+                latest = latest_data_points.get(str(machine_id))
+                yield machine_id, ServerRecord(machine_id, server["serverName"], f"{deepLinkPrefix}{machine_id}",
+                                               health_data.get(str(machine_id)),
+                                               latest.get("metricData", {}) if latest else {},
+                                               metrics.get("metricData", {}) if metrics else {})
+                continue
+            metric_data = metrics.get("metricData", {}) if metrics else {}
+            yield machine_id, {
+                "serverName": server["serverName"],
+                "deepLink": f"{deepLinkPrefix}{machine_id}",
+                "health": health_data.get(str(machine_id)),
+                "metrics": project_metric_data(metric_data) if project else metric_data
+            }
+
+    if missing:
+        logging.warning(f"Servers missing for {missing} of {len(servers)} machines")
+
+
+def getBusinessTransactionsSummary(client, workers=1, order="controller", window=None, project=False):
+    return list(iterBusinessTransactionsSummary(client, workers, order, window, project))
+
+def iterBusinessTransactionsSummary(client, workers=1, order="controller", window=None, project=False, failures=None):
+    """Yield each application's business transactions; applications that fail are logged, skipped and added to failures."""
+    window = window or TimeWindow()
+    applications = getAppList(client, window)
+    deepLinkPrefix = window.deep_link(client, "APP_BT_LIST")
+
+    def fetchApplication(application):
+        appBTData = getApplicationBusinessTransactions(client, application, window, project)
+        appBTData['deepLink'] = f"{deepLinkPrefix}&application={appBTData['applicationEntity']['entityDefinition']['entityId']}"
+        return {"application": appBTData}
+
+    missing = []
+    # "controller" keeps the order getAppList returned, "completion" yields applications as they finish
+    for application, future in fan_out(fetchApplication, applications, workers, ordered=order != "completion"):
+        try:
+            yield future.result()
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            logging.error(f"Failed to collect business transactions for application {application}: {e}")
+            missing.append(application)
+            if failures is not None:
+                failures.add(f"application {application}")
+
+    if missing:
+        logging.warning(f"Business transactions missing for {len(missing)} of {len(applications)} applications: {missing}")
+
+def getApplicationBusinessTransactions(client, application, window=None, project=False):
+    path = f"/controller/restui/v1/bt/listViewDataByColumnsV2"
+    window = window or TimeWindow()
+    body = list_request_body(
+        window,
+        {
             "queryParams": {
                 "applicationIds": [application],
                 "tags": []
@@ -405,225 +497,435 @@ def getApplicationBusinessTransactions(appd_controller_url, bearer, application)
             "filterAll": False,
             "filters": []
         },
-        "searchFilters": None,
-        "timeRangeStart": timeRangeStart,
-        "timeRangeEnd": timeRangeEnd,
-        "columnSorts": None,
-        "resultColumns": ["NAME","BT_HEALTH","AVERAGE_RESPONSE_TIME","CALL_PER_MIN","ERRORS_PER_MIN","PERCENTAGE_ERROR","PERCENTAGE_SLOW_TRANSACTIONS","PERCENTAGE_VERY_SLOW_TRANSACTIONS","PERCENTAGE_STALLED_TRANSACTIONS","END_TO_END_LATENCY_TIME","MAX_RESPONSE_TIME","MIN_RESPONSE_TIME","CALLS","SLOW_TRANSACTIONS","CPU_USED","TOTAL_ERRORS","BLOCK_TIME","WAIT_TIME","VERY_SLOW_TRANSACTIONS","STALLED_TRANSACTIONS"],
-        "offset": 0,
-        "limit": -1
-    }
-    response = requests.post(url, headers=headers, json=body)
-
-    if _debug:
-        print("Request URL:", response.request.url)
-        print("Request Headers:", response.request.headers)
-        print("Request Payload:", response.request.body)
-        print("Response:", response.status_code, response.text)
-
-    if response.status_code >= 300:
-        print(f"Error: {response.status_code} - {response.text}")
-        print("Request header:", json.dumps(headers, indent=2))
-        print("Request body:", json.dumps(body, indent=2))
-    response.raise_for_status()
+        BT_COLUMNS
+    )
+    response = client.post(path, json=body)
     data = response.json()
+    if project:
+        data['btListEntries'] = [project_bt_entry(item) for item in data['btListEntries']]
     applicationData = data["applicationEntity"]
+    deepLinkPrefix = window.deep_link(client, "APP_BT_DETAIL")
     for item in data['btListEntries']:
         item['application_name'] = applicationData['name']
         item['application_id'] = applicationData['entityDefinition']['entityId']
-        item['deepLink'] = f"{appd_controller_url}/controller/#/location=APP_BT_DETAIL&timeRange=Custom_Time_Range.BETWEEN_TIMES.{timeRangeEnd}.{timeRangeStart}.{minutes}&application={application}&businessTransaction={item['id']}&dashboardMode=force"
+        item['deepLink'] = f"{deepLinkPrefix}&application={application}&businessTransaction={item['id']}&dashboardMode=force"
     return data
 
-def get_secure_app_list(appd_controller_url, bearer):
-    request_headers = {
-        "Authorization": f"Bearer {bearer}",
-        "Content-Type": "application/json;charset=UTF-8",
-        "Accept": "application/json, text/plain, */*"
-    }
-    now = time.time()
-
-    response = requests.get(
-        f"{appd_controller_url}/controller/argento/public-api/v1/applications?max=3000",
-        headers=request_headers
-    )
-
-    if _debug:
-        print("Request URL:", response.request.url)
-        print("Request Headers:", response.request.headers)
-        print("Request Payload:", response.request.body)
-        print("Response:", response.status_code, response.text)
-
-    if response.status_code >= 300:
-        print(f"Error: {response.status_code} - {response.text}")
-        # Print the request body for debugging
-        print("Request header:", json.dumps(request_headers, indent=2))
-
-    response.raise_for_status()
+def iter_argento_items(client, path, params=None):
+    # argento pages with max/offset and may cap a page below max, so paging goes on until the reported
+    # total is reached; only without a total is a short page the last one
+    offset = 0
+    while True:
+        response = client.get(path, params={**(params or {}), "max": ARGENTO_PAGE_SIZE, "offset": offset})
+        page = response.json()
+        items = page.get('items', [])
+        yield from items
+        offset += len(items)
+        total = page.get('total')
+        if not items or (offset >= total if total is not None else len(items) < ARGENTO_PAGE_SIZE):
+            return
+
+def get_secure_app_list(client):
     apps = []
-    for item in response.json()['items']:
-        print(json.dumps(item, indent=2))
+    for item in iter_argento_items(client, "/controller/argento/public-api/v1/applications"):
         if item['applicationSecurityEnabled'] or item['applicationSecurityEnabledComputed'] is True:
             apps.append(item)
     return apps
 
-def get_application_security_attack_counts(appd_controller_url, bearer, appID):
-
-    now = time.time()
-    timeRangeStart = now - (15 * 60)
-    timeRangeEnd = now
-    startedAt = datetime.fromtimestamp(timeRangeStart, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-    endedAt = datetime.fromtimestamp(timeRangeEnd, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-
-    url = f"{appd_controller_url}/controller/argento/public-api/v1/attacks?applicationId={appID}&startedAt={startedAt}&endedAt={endedAt}&max=3000"
-    headers = {
-        'Authorization': f'Bearer {bearer}',
-        'Content-Type': 'application/json;charset=UTF-8',
-        'Accept': 'application/json, text/plain, */*'
-    }
-
-    minutes = round( (timeRangeEnd/60000) - (timeRangeStart/60000))
-    response = requests.get(url, headers=headers)
-
-    if _debug:
-        print("Request URL:", response.request.url)
-        print("Request Headers:", response.request.headers)
-        print("Request Payload:", response.request.body)
-        print("Response:", response.status_code, response.text)
-
-    if response.status_code >= 300:
-        print(f"Error: {response.status_code} - {response.text}")
-        print("Request header:", json.dumps(headers, indent=2))
-        #print("Request body:", json.dumps(body, indent=2))
-    response.raise_for_status()
-    return response.json()['items']
-
-def get_application_security_business_risk(appd_controller_url, bearer, appID):
+def iter_application_security_attacks(client, appID, window=None):
+    window = window or TimeWindow()
+    return iter_argento_items(client, "/controller/argento/public-api/v1/attacks",
+                              {"applicationId": appID, "startedAt": window.started_at, "endedAt": window.ended_at})
 
-    now = time.time()
-    timeRangeStart = now - (15 * 60)
-    timeRangeEnd = now
-    startedAt = datetime.fromtimestamp(timeRangeStart, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-    endedAt = datetime.fromtimestamp(timeRangeEnd, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+def get_application_security_attack_counts(client, appID, window=None):
+    return list(iter_application_security_attacks(client, appID, window))
 
-    url = f"{appd_controller_url}/controller/argento/public-api/v1/stats/businessRisk?applicationId={appID}&startedAt={startedAt}&endedAt={endedAt}"
-    headers = {
-        'Authorization': f'Bearer {bearer}',
-        'Content-Type': 'application/json;charset=UTF-8',
-        'Accept': 'application/json, text/plain, */*'
-    }
+def get_application_security_business_risk(client, appID, window=None):
+    window = window or TimeWindow()
+    path = f"/controller/argento/public-api/v1/stats/businessRisk?applicationId={appID}&startedAt={window.started_at}&endedAt={window.ended_at}"
 
-    minutes = round( (timeRangeEnd/60000) - (timeRangeStart/60000))
-    response = requests.get(url, headers=headers)
-
-    if _debug:
-        print("Request URL:", response.request.url)
-        print("Request Headers:", response.request.headers)
-        print("Request Payload:", response.request.body)
-        print("Response:", response.status_code, response.text)
-
-    if response.status_code >= 300:
-        print(f"Error: {response.status_code} - {response.text}")
-        print("Request header:", json.dumps(headers, indent=2))
-        #print("Request body:", json.dumps(body, indent=2))
-    response.raise_for_status()
+    response = client.get(path)
     return response.json()['items']
 
-def get_application_security_vulnerabilities(appd_controller_url, bearer, appID):
-
-    now = time.time()
-    timeRangeStart = now - (15 * 60)
-    timeRangeEnd = now
-    startedAt = datetime.fromtimestamp(timeRangeStart, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-    endedAt = datetime.fromtimestamp(timeRangeEnd, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-
-    url = f"{appd_controller_url}/controller/argento/public-api/v1/vulnerabilities?applicationId={appID}&startedAt={startedAt}&endedAt={endedAt}&max=3000"
-    headers = {
-        'Authorization': f'Bearer {bearer}',
-        'Content-Type': 'application/json;charset=UTF-8',
-        'Accept': 'application/json, text/plain, */*'
+def iter_application_security_vulnerabilities(client, appID, window=None):
+    window = window or TimeWindow()
+    return iter_argento_items(client, "/controller/argento/public-api/v1/vulnerabilities",
+                              {"applicationId": appID, "startedAt": window.started_at, "endedAt": window.ended_at})
+
+def get_application_security_vulnerabilities(client, appID, window=None):
+    return list(iter_application_security_vulnerabilities(client, appID, window))
+
+def iter_secure_application_items(client, kind, window=None):
+    window = window or TimeWindow()
+    fetch = {"attacks": iter_application_security_attacks, "vulnerabilities": iter_application_security_vulnerabilities}[kind]
+    for application in get_secure_app_list(client):
+        for item in fetch(client, application['appdApplicationId'], window):
+            item['appdApplicationId'] = application['appdApplicationId']
+            yield item
+
+def get_application_security_summary(client, workers=1, window=None):
+    applications = get_secure_app_list(client)
+    for _ in iter_application_security_summary(client, workers, applications, window):
+        pass
+    return applications
+
+def iter_application_security_summary(client, workers=1, applications=None, window=None, failures=None):
+    """Yield each secure application once all its calls are done; a failed call leaves its field None and is added to failures."""
+    window = window or TimeWindow()
+    if applications is None:
+        applications = get_secure_app_list(client)
+    calls = {
+        "attacks": get_application_security_attack_counts,
+        "business_risk": get_application_security_business_risk,
+        "vulnerabilities": get_application_security_vulnerabilities,
     }
-
-    minutes = round( (timeRangeEnd/60000) - (timeRangeStart/60000))
-    response = requests.get(url, headers=headers)
-
-    if _debug:
-        print("Request URL:", response.request.url)
-        print("Request Headers:", response.request.headers)
-        print("Request Payload:", response.request.body)
-        print("Response:", response.status_code, response.text)
-
-    if response.status_code >= 300:
-        print(f"Error: {response.status_code} - {response.text}")
-        print("Request header:", json.dumps(headers, indent=2))
-        #print("Request body:", json.dumps(body, indent=2))
-    response.raise_for_status()
-    return response.json()['items']
-
-def get_application_security_summary(appd_controller_url, bearer):
-    applications = get_secure_app_list(appd_controller_url, bearer)
-    print("applications returned:", json.dumps(applications, indent=2))
-    now = round(time.time()*1000)
-    timeRangeStart = now - (15 * 60000)
-    timeRangeEnd = now
-    minutes = round( (timeRangeEnd/60000) - (timeRangeStart/60000))
-    data = []
-    for application in applications:
-        application['attacks'] = get_application_security_attack_counts(appd_controller_url, bearer, application['appdApplicationId'])
-        application['business_risk'] = get_application_security_business_risk(appd_controller_url, bearer, application['appdApplicationId'])
-        application['vulnerabilities'] = get_application_security_vulnerabilities(appd_controller_url, bearer, application['appdApplicationId'])
-        data.append(application)
-    return data
+    # every (application, endpoint) pair is its own task, so the pool size caps the calls in flight
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {}
+        remaining = {}
+        for application in applications:
+            remaining[application['appdApplicationId']] = len(calls)
+            for field, call in calls.items():
+                futures[executor.submit(call, client, application['appdApplicationId'], window)] = (application, field)
+        for future in as_completed(futures):
+            application, field = futures[future]
+            try:
+                application[field] = future.result()
+            except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+                logging.error(f"Failed to collect security {field} for application {application['appdApplicationId']}: {e}")
+                application[field] = None
+                if failures is not None:
+                    failures.add(f"security {field} of application {application['appdApplicationId']}",
+                                 partial=application['appdApplicationId'])
+            remaining[application['appdApplicationId']] -= 1
+            if remaining[application['appdApplicationId']] == 0:
+                yield application
+
+class CollectorOptions:
+    """How the collectors query the controller, shared by a single run and every daemon collector."""
+
+    def __init__(self, workers=1, order="controller", server_chunk_size=SERVER_CHUNK_SIZE, server_format="nested",
+                 database_chunk_size=DATABASE_CHUNK_SIZE, database_data_points=DATABASE_DATA_POINTS, database_summary=False,
+                 window_minutes=DEFAULT_WINDOW_MINUTES, projection=False):
+        self.workers = workers
+        self.order = order
+        self.server_chunk_size = server_chunk_size
+        self.server_format = server_format
+        self.database_chunk_size = database_chunk_size
+        self.database_data_points = database_data_points
+        self.database_summary = database_summary
+        self.window_minutes = window_minutes
+        self.projection = projection
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.workers, args.order, args.server_chunk_size, args.server_format,
+                   args.database_chunk_size, args.database_data_points, args.database_summary, args.window_minutes,
+                   args.projection)
+
+def iter_events(client, data_type, options=None, window=None, failures=None):
+    """Yield one record per entity of data_type, as soon as each one is collected; what fails goes into failures."""
+    options = options or CollectorOptions()
+    window = window or TimeWindow()
+    if data_type == "applications":
+        yield from getApplicationSummary(client, window)['data']
+    elif data_type == "databases":
+        yield from iterDatabaseSummary(client, options.workers, options.database_chunk_size,
+                                       options.database_data_points, options.database_summary, window, failures)
+    elif data_type == "servers":
+        if options.server_format == "flat":
+            for _, server in iterServerSummary(client, options.workers, options.server_chunk_size, options.order,
+                                               compact=True, window=window, failures=failures):
+                yield server.flatten()
+        else:
+            for machine_id, server in iterServerSummary(client, options.workers, options.server_chunk_size, options.order,
+                                                        window=window, project=options.projection, failures=failures):
+                yield {"machineId": machine_id, **server}
+    elif data_type == "business_transactions":
+        for app in iterBusinessTransactionsSummary(client, options.workers, options.order, window, options.projection,
+                                                   failures):
+            yield from app['application']['btListEntries']
+    elif data_type == "security":
+        yield from iter_application_security_summary(client, options.workers, window=window, failures=failures)
+    elif data_type in ["attacks", "vulnerabilities"]:
+        yield from iter_secure_application_items(client, data_type, window)
+
+def iter_collected_events(client, data_type, options=None, tracker=None, window=None):
+    """iter_events, reduced to the new, changed and removed entities when there is a change tracker."""
+    if tracker is None:
+        return iter_events(client, data_type, options, window)
+    failures = PollFailures()
+    events = iter_events(client, data_type, options, window, failures)
+    return tracker.changes(client.controller_url, data_type, events, ENTITY_KEYS[data_type], failures)
+
+_emit_lock = threading.Lock()
+
+def emit(record, output_format):
+    # records from several controllers are emitted from their own threads
+    if output_format == "ndjson":
+        line = appd_json.dumps(record) + "\n"
+        with _emit_lock:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+    else:
+        text = appd_json.dumps(record, indent=True)
+        with _emit_lock:
+            print(text)
+
+def collect_controllers(clients, data_type, output_format, tracker=None, window=None):
+    """Emit data_type from every (client, options) pair at once, each record with a controller field.
+
+    A controller that fails doesn't stop the others; the names of the ones that failed are returned.
+    """
+    def collect(client, options):
+        client.get_bearer_token()
+        for event in iter_collected_events(client, data_type, options, tracker, window):
+            emit({"controller": client.name, **event}, output_format)
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=len(clients)) as executor:
+        futures = {executor.submit(collect, client, options): client for client, options in clients}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+                logging.error(f"{data_type} collection from {futures[future].name} failed: {e}")
+                failed.append(futures[future].name)
+    return failed
+
+class RotatingFileOutput:
+    """One size-rotated NDJSON file per collector under directory."""
+
+    def __init__(self, directory, max_bytes, backups):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.loggers = {}
+        self._lock = threading.Lock()
+
+    def write(self, stream, record):
+        with self._lock:
+            if stream not in self.loggers:
+                handler = RotatingFileHandler(os.path.join(self.directory, f"{stream}.json"),
+                                              maxBytes=self.max_bytes, backupCount=self.backups)
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                logger = logging.getLogger(f"appdynamics.output.{stream}")
+                logger.setLevel(logging.INFO)
+                logger.propagate = False
+                logger.addHandler(handler)
+                self.loggers[stream] = logger
+        self.loggers[stream].info(appd_json.dumps(record))
+
+    def close(self):
+        for logger in self.loggers.values():
+            for handler in logger.handlers:
+                handler.close()
+
+class SocketOutput:
+    """NDJSON over TCP, e.g. to a Splunk TCP input; every record carries the collector that produced it.
+
+    Connecting and sending time out after timeout seconds, so a stalled input drops records instead of
+    blocking every collector, which share the connection.
+    """
+
+    def __init__(self, address, timeout=SOCKET_TIMEOUT):
+        host, port = address.rsplit(":", 1)
+        self.address = (host, int(port))
+        self.timeout = timeout
+        self.sock = None
+        self._lock = threading.Lock()
+
+    def write(self, stream, record):
+        line = (appd_json.dumps({**record, "stream": stream}) + "\n").encode()
+        with self._lock:
+            try:
+                if self.sock is None:
+                    self.sock = socket.create_connection(self.address, timeout=self.timeout)
+                self.sock.sendall(line)
+            except OSError as e:
+                logging.error(f"Dropped {stream} record, could not write to {self.address[0]}:{self.address[1]}: {e}")
+                self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+def run_collector(client, data_type, interval, output, stop, options=None, tracker=None, report=None, controller=None):
+    """Poll data_type every interval seconds until stop is set; with a controller, records carry it as a field."""
+    metrics = {"collector": data_type, "interval": interval, "runs": 0, "failures": 0, "overruns": 0,
+               "last_duration": None, "max_duration": 0.0, "total_duration": 0.0, "last_events": 0}
+    if controller:
+        metrics["controller"] = controller
+    next_run = time.monotonic()
+    while not stop.is_set():
+        started = time.monotonic()
+        events = 0
+        # a fresh window every poll, shared by every request the poll makes
+        window = TimeWindow(options.window_minutes if options else DEFAULT_WINDOW_MINUTES)
+        try:
+            if client.bearer is None:
+                # a controller that couldn't be reached at startup is tried again every poll
+                client.get_bearer_token()
+            for event in iter_collected_events(client, data_type, options, tracker, window):
+                output.write(data_type, {"controller": controller, **event} if controller else event)
+                events += 1
+        except Exception:
+            # any failure costs this poll only, the collector's thread goes on to the next slot
+            logging.exception(f"{data_type} collection{f' from {controller}' if controller else ''} failed")
+            metrics["failures"] += 1
+        duration = time.monotonic() - started
+
+        metrics["runs"] += 1
+        metrics["last_events"] = events
+        metrics["last_duration"] = round(duration, 3)
+        metrics["max_duration"] = round(max(metrics["max_duration"], duration), 3)
+        metrics["total_duration"] = round(metrics["total_duration"] + duration, 3)
+        if duration > interval:
+            metrics["overruns"] += 1
+            logging.warning(f"{data_type} collection{f' from {controller}' if controller else ''} took {duration:.1f}s, "
+                            f"longer than its {interval}s interval")
+        output.write("daemon_metrics", {**metrics, "timestamp": round(time.time() * 1000)})
+        if report is not None:
+            report()
+
+        # after an overrun, skip the missed slots rather than running back to back
+        next_run += interval
+        now = time.monotonic()
+        if next_run < now:
+            next_run += ((now - next_run) // interval + 1) * interval
+        stop.wait(next_run - now)
+
+def run_daemon(clients, args, tracker=None, report=None, tag=False):
+    """Run every collector against every (client, options) pair, each on its own thread; with tag, records carry the controller."""
+    intervals = {data_type: args.interval for data_type in args.collectors}
+    for override in args.collector_interval:
+        data_type, seconds = override.split("=", 1)
+        intervals[data_type] = float(seconds)
+    output = SocketOutput(args.socket) if args.socket else RotatingFileOutput(args.output_dir, args.max_bytes, args.backups)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    threads = [threading.Thread(target=run_collector, name=f"{client.name}/{data_type}", daemon=True,
+                                args=(client, data_type, intervals[data_type], output, stop, options, tracker, report,
+                                      client.name if tag else None))
+               for client, options in clients for data_type in args.collectors]
+    for thread in threads:
+        thread.start()
+    logging.info(f"Collecting {', '.join(f'{t} every {intervals[t]}s' for t in args.collectors)}"
+                 f" from {', '.join(client.name for client, _ in clients)}")
+    # join with a timeout so the main thread keeps handling signals
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(timeout=1)
+    output.close()
 
 
 def main():
-    global _debug
-
     parser = argparse.ArgumentParser(description="AppDynamics Configuration Script")
     parser.add_argument("-c", "--config", default="appdynamics-configuration.sh", help="Config file")
+    parser.add_argument("--controllers", help="JSON or YAML file listing several controllers to poll at once instead of --config, every record then gets a controller field")
     parser.add_argument("-d", "--debug", action="store_true", help="Enable debug mode")
-    parser.add_argument("-t", "--type", default="applications", choices=["applications", "databases", "servers", "business_transactions", "security"], help="Type of data to retrieve")
+    parser.add_argument("-t", "--type", default="applications", choices=["applications", "databases", "servers", "business_transactions", "security", "attacks", "vulnerabilities"], help="Type of data to retrieve")
+    parser.add_argument("-f", "--format", default="json", choices=["json", "ndjson"], help="Pretty-printed JSON, or one compact JSON event per entity per line as soon as it is collected")
+    parser.add_argument("--window-minutes", type=int, default=DEFAULT_WINDOW_MINUTES, help="Minutes of data each poll asks the controller for, ending at the start of the current minute")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of concurrent controller requests for business transaction, database, server and security collection")
+    parser.add_argument("--database-chunk-size", type=int, default=DATABASE_CHUNK_SIZE, help="Database ids per database metrics request")
+    parser.add_argument("--database-data-points", type=int, default=DATABASE_DATA_POINTS, help="Data points per database metric to ask the controller for")
+    parser.add_argument("--database-summary", action="store_true", help="Replace each database metric's time series with its last, average and maximum values")
+    parser.add_argument("--server-format", default="nested", choices=["nested", "flat"], help="Servers with the controller's raw metric series, or one fixed column per metric for its latest value and daily rollup")
+    parser.add_argument("--projection", action="store_true", help="Keep only the requested columns and identity fields of business transactions, and the time, value, min and max of server metric data points")
+    parser.add_argument("--json-backend", default="auto", choices=JSON_BACKENDS, help="JSON library for decoding responses and writing events, auto uses orjson when it is installed")
+    parser.add_argument("--server-chunk-size", type=int, default=SERVER_CHUNK_SIZE, help="Machine ids per server health and metrics request")
+    parser.add_argument("--order", default="controller", choices=["controller", "completion"], help="Emit business transactions and servers in controller order or as each application or chunk of machines completes")
+    parser.add_argument("--changed-only", action="store_true", help="Emit only entities that are new, changed or removed since the last run, as one event each")
+    parser.add_argument("--state-db", default=DEFAULT_STATE_DB, help="SQLite file remembering what earlier runs emitted, for --changed-only")
+    parser.add_argument("--full-snapshot-interval", type=float, default=DEFAULT_FULL_SNAPSHOT_INTERVAL, help="Seconds between runs that emit every entity, unchanged ones included, with --changed-only")
+    parser.add_argument("--daemon", action="store_true", help="Keep running and poll every collector on its own schedule, writing the --stats report after every poll")
+    parser.add_argument("--collectors", nargs="+", default=COLLECTORS, choices=COLLECTORS, help="Collectors to run in daemon mode")
+    parser.add_argument("--interval", type=float, default=300, help="Seconds between runs of each collector in daemon mode")
+    parser.add_argument("--collector-interval", action="append", default=[], metavar="TYPE=SECONDS", help="Override the interval for one collector, may be repeated")
+    parser.add_argument("--output-dir", default="output", help="Directory for the daemon's rotating output files")
+    parser.add_argument("--max-bytes", type=int, default=50 * 1024 * 1024, help="Size at which daemon output files are rotated")
+    parser.add_argument("--backups", type=int, default=5, help="Rotated daemon output files to keep per collector")
+    parser.add_argument("--socket", metavar="HOST:PORT", help="Send daemon output as NDJSON over TCP instead of writing files")
+    add_client_arguments(parser)
     args = parser.parse_args()
 
-    logging.basicConfig(level=logging.INFO)
-    if args.debug:
-        logging.basicConfig(level=logging.DEBUG)
-        _debug = True
-
-    config = load_config(args.config)
-    exec(config, globals())
-
-    appd_controller_url = globals().get("APPD_CONTROLLER_URL")
-    if appd_controller_url.endswith('/'):
-        appd_controller_url = appd_controller_url[:-1]
-    appd_client_id = globals().get("APPD_CLIENT_ID")
-    appd_client_secret = globals().get("APPD_CLIENT_SECRET")
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
 
-    if not all([appd_controller_url, appd_client_id, appd_client_secret]):
-        print(f"Could not load AppDynamics Configuration from {args.config}, please set that up or something")
+    try:
+        appd_json.set_backend(args.json_backend)
+    except ValueError as e:
+        print(f"Can't use --json-backend {args.json_backend}: {e}")
         exit(1)
 
-    bearer = get_bearer_token(appd_controller_url, appd_client_id, appd_client_secret)
-
-    if args.type == "applications":
-        appData = getApplicationSummary(appd_controller_url, bearer)
-        print(json.dumps(appData, indent=2))
-    elif args.type == "databases":
-        dbData = getDatabaseSummary(appd_controller_url, bearer)
-        print(json.dumps(dbData, indent=2))
-    elif args.type == "servers":
-        serverData = getServerSummary(appd_controller_url, bearer)
-        print(json.dumps(serverData, indent=2))
-    elif args.type == "business_transactions":
-        btData = getBusinessTransactionsSummary(appd_controller_url, bearer)
-        for app in btData:
-            bt_list_entries = app['application']['btListEntries']
-            for business_transaction in bt_list_entries:
-                print(json.dumps(business_transaction, indent=2))
-    elif args.type == "security":
-        secData = get_application_security_summary(appd_controller_url, bearer)
-        for app in secData:
-            print(json.dumps(app, indent=2))
-
+    if args.controllers:
+        controllers = load_controllers(args.controllers)
+    else:
+        appd_controller_url, appd_client_id, appd_client_secret = read_config(args.config)
+        if not all([appd_controller_url, appd_client_id, appd_client_secret]):
+            print(f"Could not load AppDynamics Configuration from {args.config}, please set that up or something")
+            exit(1)
+        controllers = [{"name": None, "url": appd_controller_url, "client_id": appd_client_id,
+                        "client_secret": appd_client_secret, "workers": None, "rate_limit": None}]
+
+    shared = shared_from_args(args)
+    response_cache, stats = shared["response_cache"], shared["stats"]
+    # a client per controller, so each has its own connections, rate limit and concurrency
+    clients = []
+    for controller in controllers:
+        options = CollectorOptions.from_args(args)
+        options.workers = controller["workers"] or args.workers
+        # in daemon mode every collector shares the pool, so size it for all of them at once
+        pool_size = options.workers * (len(args.collectors) if args.daemon else 1)
+        client = client_from_args(args, controller["url"], controller["client_id"], controller["client_secret"], pool_size,
+                                  controller["rate_limit"], controller["name"], shared)
+        clients.append((client, options))
+
+    report = (lambda: stats.write(args.stats, args.stats_file)) if stats is not None else None
+    tracker = ChangeTracker(args.state_db, args.full_snapshot_interval) if args.changed_only else None
+    window = TimeWindow(args.window_minutes)
+    # attacks and vulnerabilities are always one compact line per item, written as each page arrives
+    output_format = "ndjson" if args.type in ["attacks", "vulnerabilities"] else args.format
+
+    failed = []
+    if args.controllers and args.daemon:
+        # each controller's collectors run on their own threads, one that can't be reached fails on its own
+        run_daemon(clients, args, tracker, report, tag=True)
+    elif args.controllers:
+        # every record is its own event here, json documents can't mix controllers
+        failed = collect_controllers(clients, args.type, output_format, tracker, window)
+    else:
+        client = clients[0][0]
+        client.get_bearer_token()
+        if args.daemon:
+            run_daemon(clients, args, tracker, report)
+        elif tracker is None and args.format == "json" and args.type == "applications":
+            emit(getApplicationSummary(client, window), args.format)
+        elif tracker is None and args.format == "json" and args.type == "databases":
+            emit(getDatabaseSummary(client, args.workers, args.database_chunk_size, args.database_data_points, args.database_summary,
+                                    window), args.format)
+        elif tracker is None and args.format == "json" and args.type == "servers":
+            if args.server_format == "flat":
+                servers = getServerSummary(client, args.workers, args.server_chunk_size, compact=True, window=window)
+                emit([server.flatten() for server in servers.values()], args.format)
+            else:
+                emit(getServerSummary(client, args.workers, args.server_chunk_size, window=window, project=args.projection),
+                     args.format)
+        else:
+            for event in iter_collected_events(client, args.type, clients[0][1], tracker, window):
+                emit(event, output_format)
+
+    if response_cache is not None:
+        logging.info(response_cache.summary())
+    if report is not None and not args.daemon:
+        report()
+    if failed:
+        logging.error(f"Collection failed for {', '.join(failed)}")
+        exit(1)
 
 if __name__ == "__main__":
     main()